@@ -0,0 +1,48 @@
+"""
+Стоимость кодирования и декодирования тела месседжа для зарегистрированных кодеков.
+
+Брокер не нужен. Полезная нагрузка похожа на ответ сервиса Б (список постов).
+
+    python benchmarks/codecs.py --sizes 1 10 100 1000
+"""
+import argparse
+import time
+
+import common  # noqa: F401  Добавляет serviceA/src в sys.path.
+from rabbit.codecs import CODECS, RawCodec
+
+
+def make_posts(count: int) -> list:
+    return [
+        {"userId": i % 10, "id": i, "title": f"post title {i}", "body": "lorem ipsum dolor sit amet " * 8}
+        for i in range(count)
+    ]
+
+
+def measure(func, arg, repeat: int) -> float:
+    """Среднее время одного вызова в микросекундах."""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(arg)
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def main(args):
+    print(f"{'codec':<28} {'posts':>6} {'bytes':>9} {'encode us':>11} {'decode us':>11}")
+    for size in args.sizes:
+        payload = make_posts(size)
+        repeat = max(10, args.budget // max(size, 1))
+        for content_type, codec in CODECS.items():
+            if isinstance(codec, RawCodec):
+                continue
+            body = codec.encode(payload)
+            encode = measure(codec.encode, payload, repeat)
+            decode = measure(codec.decode, body, repeat)
+            print(f"{content_type:<28} {size:>6} {len(body):>9} {encode:>11.1f} {decode:>11.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--budget", type=int, default=20000, help="Суммарное количество постов на один замер")
+    main(parser.parse_args())
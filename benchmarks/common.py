@@ -0,0 +1,40 @@
+"""Общие помощники для бенчмарков."""
+import os
+import sys
+import time
+
+# Бенчмарки используют код брокера из сервиса А (в сервисе Б он продублирован).
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "serviceA", "src")
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+
+def percentile(values, percent: float) -> float:
+    """Перцентиль по отсортированному списку значений (метод ближайшего ранга)."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(percent / 100 * len(values))) - 1))
+    return values[index]
+
+
+def report(name: str, count: int, elapsed: float, latencies=None):
+    """Печать результата одного сценария."""
+    line = f"{name:<32} {count:>8} ops  {count / elapsed:>10.1f} ops/s"
+    if latencies:
+        line += (
+            f"  p50={percentile(latencies, 50) * 1000:.2f}ms"
+            f"  p99={percentile(latencies, 99) * 1000:.2f}ms"
+        )
+    print(line)
+
+
+class Timer:
+    """Контекстный менеджер для замера времени выполнения блока."""
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
@@ -0,0 +1,98 @@
+"""
+Нагрузочный тест обращений к внешнему API против локального HTTP-заглушки.
+
+Сравнивает три варианта обработки concurrency одновременных запросов внутри event loop:
+блокирующий requests.get (как было в сервисах), общий асинхронный клиент с пулом соединений
+и тот же клиент с кэшем stale-while-revalidate.
+
+    python benchmarks/http_client.py --requests 500 --concurrency 50 --delay 0.02
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import common  # noqa: F401  Добавляет serviceA/src в sys.path.
+from common import Timer, report
+from http_client import SWRCache, cached_get_json, close_client, get_json
+
+POSTS = [{"userId": i % 10, "id": i, "title": f"title {i}", "body": "body " * 20} for i in range(100)]
+
+
+def start_stub_server(delay: float) -> ThreadingHTTPServer:
+    body = json.dumps(POSTS).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Поддержка keep-alive.
+
+        def do_GET(self):
+            time.sleep(delay)  # Задержка внешнего API.
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        request_queue_size = 256  # Иначе одновременные подключения упираются в backlog.
+
+    server = Server(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def run(name: str, fetch, total: int, concurrency: int):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(arrived: float):
+        async with semaphore:
+            await fetch()
+        latencies.append(time.perf_counter() - arrived)
+
+    # Все запросы приходят одновременно, задержка считается с момента прихода
+    # вместе с ожиданием в очереди, как ее видит клиент сервиса.
+    with Timer() as timer:
+        arrived = time.perf_counter()
+        await asyncio.gather(*(one(arrived) for _ in range(total)))
+    report(name, total, timer.elapsed, latencies)
+
+
+async def main(args):
+    server = start_stub_server(args.delay)
+    url = f"http://127.0.0.1:{server.server_address[1]}/posts"
+
+    try:
+        import requests
+    except ImportError:
+        requests = None
+
+    if requests is not None:
+        async def blocking():
+            # Так endpoint-ы сервисов работали раньше: синхронный вызов внутри async def.
+            return requests.get(url).json()
+
+        await run("requests.get in event loop", blocking, args.requests, args.concurrency)
+
+    await run("pooled async client", lambda: get_json(url), args.requests, args.concurrency)
+
+    cache = SWRCache(ttl=args.ttl, stale_ttl=60)
+    await run("pooled client + SWR cache", lambda: cached_get_json(url, cache), args.requests, args.concurrency)
+
+    await close_client()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.02, help="Задержка ответа заглушки в секундах")
+    parser.add_argument("--ttl", type=float, default=1.0, help="TTL кэша в секундах")
+    asyncio.run(main(parser.parse_args()))
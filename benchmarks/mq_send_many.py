@@ -0,0 +1,41 @@
+"""
+Пропускная способность MessageQueue.send против send_many с окном подтверждений.
+
+Требует запущенный RabbitMQ (docker-compose up -d rabbitmq).
+
+    python benchmarks/mq_send_many.py --messages 10000 --window 256
+"""
+import argparse
+import asyncio
+
+import common  # noqa: F401  Добавляет serviceA/src в sys.path.
+from common import Timer, report
+from rabbit.server import MessageQueue, connect_to_broker
+
+QUEUE_NAME = "bench_mq_queue"
+
+
+async def main(args):
+    channel = await connect_to_broker()
+    mq = MessageQueue(channel)
+    queue = await channel.declare_queue(QUEUE_NAME, auto_delete=True)
+    payload = {"text": "x" * args.size}
+
+    with Timer() as timer:
+        for _ in range(args.messages):
+            await mq.send(QUEUE_NAME, payload)
+    report("send (sequential confirms)", args.messages, timer.elapsed)
+
+    with Timer() as timer:
+        await mq.send_many(QUEUE_NAME, [payload] * args.messages, window=args.window)
+    report(f"send_many window={args.window}", args.messages, timer.elapsed)
+
+    await queue.purge()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--window", type=int, default=256)
+    parser.add_argument("--size", type=int, default=100, help="Размер полезной нагрузки в байтах")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,55 @@
+"""
+Сравнение режимов получения ответов RPC: per_call, shared и direct.
+
+Требует запущенный RabbitMQ (docker-compose up -d rabbitmq), параметры подключения
+берутся из переменных окружения RMQ_*.
+
+    python benchmarks/rpc_reply_modes.py --calls 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import time
+
+import common  # noqa: F401  Добавляет serviceA/src в sys.path.
+from common import Timer, report
+from rabbit.server import RPC, connect_to_broker
+
+QUEUE_NAME = "bench_rpc_queue"
+
+
+async def echo(**kwargs):
+    return kwargs
+
+
+async def run_mode(channel, mode: str, calls: int, concurrency: int):
+    rpc = RPC(channel, reply_mode=mode)
+    await rpc.setup_reply_queue()
+
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            started = time.perf_counter()
+            await rpc.call(QUEUE_NAME, i=i)
+            latencies.append(time.perf_counter() - started)
+
+    with Timer() as timer:
+        await asyncio.gather(*(one(i) for i in range(calls)))
+    report(f"rpc reply_mode={mode}", calls, timer.elapsed, latencies)
+
+
+async def main(args):
+    channel = await connect_to_broker()
+    await RPC(channel).consume_queue(echo, QUEUE_NAME)
+
+    for mode in args.modes:
+        await run_mode(channel, mode, args.calls, args.concurrency)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--modes", nargs="+", default=list(RPC.REPLY_MODES), choices=RPC.REPLY_MODES)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,147 @@
+"""
+Набор end-to-end бенчмарков MessageQueue и RPC.
+
+По умолчанию работает с брокером в памяти процесса (rabbit.memory), с --backend amqp
+те же сценарии выполняются на реальном RabbitMQ (параметры подключения из переменных RMQ_*).
+
+    python benchmarks/suite.py
+    python benchmarks/suite.py --backend amqp --scenarios mq rpc
+"""
+import argparse
+import asyncio
+import os
+import time
+import tracemalloc
+from uuid import uuid4
+
+import common  # noqa: F401  Добавляет serviceA/src в sys.path.
+from common import Timer, report
+
+SCENARIOS = ("mq", "rpc", "futures")
+
+
+async def bench_mq(server, args):
+    """Пропускная способность публикации и обработки месседжей."""
+    queue_name = f"bench_mq_{uuid4().hex[:8]}"
+    mq = server.MessageQueue(pool=server.create_pool())
+    received = 0
+    done = asyncio.Event()
+
+    async def handler(message):
+        nonlocal received
+        received += 1
+        if received == args.messages:
+            done.set()
+
+    await mq.consume_queue(handler, queue_name, auto_delete_queue=True, concurrency=args.concurrency)
+    payload = {"text": "x" * args.size}
+
+    with Timer() as publish:
+        await mq.send_many(queue_name, [payload] * args.messages)
+    report("mq publish (send_many)", args.messages, publish.elapsed)
+
+    with Timer() as consume:
+        await done.wait()
+    report("mq publish + consume", args.messages, publish.elapsed + consume.elapsed)
+
+    await mq.close()
+
+
+async def bench_rpc(server, args):
+    """Перцентили задержки RPC для каждого режима получения ответов."""
+    queue_name = f"bench_rpc_{uuid4().hex[:8]}"
+    pool = server.create_pool()
+
+    async def echo(**kwargs):
+        return kwargs
+
+    responder = server.RPC(pool=pool)
+    await responder.consume_queue(echo, queue_name, concurrency=args.concurrency)
+
+    for mode in server.RPC.REPLY_MODES:
+        rpc = server.RPC(pool=pool, reply_mode=mode)
+        await rpc.setup_reply_queue()
+        latencies = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def one(i):
+            async with semaphore:
+                started = time.perf_counter()
+                await rpc.call(queue_name, i=i)
+                latencies.append(time.perf_counter() - started)
+
+        with Timer() as timer:
+            await asyncio.gather(*(one(i) for i in range(args.calls)))
+        report(f"rpc round trip ({mode})", args.calls, timer.elapsed, latencies)
+
+    await responder.close()
+
+
+async def bench_futures(server, args):
+    """Рост RPC.futures и памяти при длительной нагрузке, часть вызовов завершается по таймауту."""
+    queue_name = f"bench_futures_{uuid4().hex[:8]}"
+    pool = server.create_pool()
+
+    async def sometimes_slow(i):
+        # Каждый десятый ответ приходит позже таймаута вызывающей стороны.
+        if i % 10 == 0:
+            await asyncio.sleep(args.timeout * 2)
+        return i
+
+    responder = server.RPC(pool=pool)
+    await responder.consume_queue(sometimes_slow, queue_name, concurrency=args.concurrency * 2)
+    rpc = server.RPC(pool=pool, timeout=args.timeout)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    peak_futures = 0
+    timeouts = 0
+
+    async def sample():
+        nonlocal peak_futures
+        while True:
+            peak_futures = max(peak_futures, len(server.RPC.futures))
+            await asyncio.sleep(0.001)
+
+    sampler = asyncio.get_event_loop().create_task(sample())
+    for batch in range(args.batches):
+        calls = [(queue_name, {"i": i}) for i in range(args.concurrency)]
+        results = await rpc.call_many(calls, timeout=args.timeout, return_partial=True)
+        timeouts += sum(isinstance(result, server.RPCTimeoutError) for result in results)
+    sampler.cancel()
+
+    await asyncio.sleep(args.timeout * 2)  # Опоздавшие ответы приходят и отбрасываются.
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(
+        f"{'rpc futures under load':<32} {args.batches * args.concurrency:>8} calls"
+        f"  timeouts={timeouts}  peak_futures={peak_futures}  futures_after={len(server.RPC.futures)}"
+        f"  memory_growth={(current - baseline) / 1024:.1f}KiB"
+    )
+    await responder.close()
+
+
+async def main(args):
+    # Бэкенд выбирается до импорта модуля т.к параметры подключения читаются при импорте.
+    os.environ["RMQ_BACKEND"] = args.backend
+    from rabbit import server
+
+    print(f"backend={args.backend}")
+    for scenario in args.scenarios:
+        await {"mq": bench_mq, "rpc": bench_rpc, "futures": bench_futures}[scenario](server, args)
+
+    await server.create_pool().close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=("memory", "amqp"), default="memory")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--calls", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--size", type=int, default=100, help="Размер полезной нагрузки MQ в байтах")
+    parser.add_argument("--batches", type=int, default=100, help="Количество пакетов вызовов в сценарии futures")
+    parser.add_argument("--timeout", type=float, default=0.05, help="Таймаут RPC в сценарии futures")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any
+
+import httpx
+
+# Параметры пула соединений к внешним API.
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "10"))
+
+# Общий клиент процесса, соединения переиспользуются между запросами (keep-alive).
+HTTP_CLIENT = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Общий асинхронный HTTP-клиент, создается при первом обращении."""
+    global HTTP_CLIENT
+
+    if HTTP_CLIENT is None or HTTP_CLIENT.is_closed:
+        HTTP_CLIENT = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+            timeout=HTTP_TIMEOUT,
+        )
+    return HTTP_CLIENT
+
+
+async def close_client():
+    global HTTP_CLIENT
+
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+        HTTP_CLIENT = None
+
+
+async def get_json(url: str, **kwargs) -> Any:
+    """GET-запрос через общий клиент, возвращает тело ответа из JSON."""
+    response = await get_client().get(url, **kwargs)
+    response.raise_for_status()
+    return response.json()
+
+
+class SWRCache:
+    """
+    TTL-кэш со stale-while-revalidate.
+
+    Свежая запись (младше ttl) отдается из памяти. Устаревшая запись (младше ttl + stale_ttl) тоже
+    отдается из памяти, но при этом в фоне запускается одно обновление. Если записи нет или она слишком старая,
+    вызов ждет загрузку, одновременные вызовы ждут одну и ту же загрузку.
+    """
+
+    def __init__(self, ttl: float = 30, stale_ttl: float = 300):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = {}  # key -> (fetched_at, value)
+        self.refreshing = {}  # key -> asyncio.Task
+
+    async def get(self, key, fetch) -> Any:
+        entry = self.entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                return entry[1]
+            if age < self.ttl + self.stale_ttl:
+                self.refresh(key, fetch)
+                return entry[1]
+
+        return await asyncio.shield(self.refresh(key, fetch))
+
+    def refresh(self, key, fetch) -> asyncio.Task:
+        """Запуск загрузки если она еще не выполняется."""
+        task = self.refreshing.get(key)
+        if task is None:
+            task = asyncio.get_event_loop().create_task(self.load(key, fetch))
+            task.add_done_callback(self.on_loaded)
+            self.refreshing[key] = task
+        return task
+
+    @staticmethod
+    def on_loaded(task: asyncio.Task):
+        # Ошибку фонового обновления некому получить, поэтому она логируется, а в кэше остается старая запись.
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"Cache refresh failed: {task.exception()!r}")
+
+    async def load(self, key, fetch) -> Any:
+        try:
+            value = await fetch()
+            self.entries[key] = (time.monotonic(), value)
+            return value
+        finally:
+            self.refreshing.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+HTTP_CACHE = SWRCache(
+    ttl=float(os.environ.get("HTTP_CACHE_TTL", "30")),
+    stale_ttl=float(os.environ.get("HTTP_CACHE_STALE_TTL", "300")),
+)
+
+
+async def cached_get_json(url: str, cache: SWRCache = None) -> Any:
+    """GET-запрос с кэшированием ответа (по умолчанию в общем кэше процесса)."""
+    cache = cache or HTTP_CACHE
+    return await cache.get(url, lambda: get_json(url))
@@ -1,23 +1,81 @@
-import aio_pika
-import requests
+import asyncio
+import logging
+import os
+
 import uvicorn
 from fastapi import FastAPI
-from rabbit.server import mq, rpc, connect_to_broker
+from fastapi.responses import Response, StreamingResponse
+from http_client import cached_get_json, close_client
+from rabbit import metrics
+from rabbit.server import mq, rpc, create_pool
+
+# Количество шардов mq_sharded_queue, должно совпадать с сервисом B.
+MQ_SHARDS = int(os.environ.get("MQ_SHARDS", "8"))
+# Размер локального outbox для mq.send (0 - публикация напрямую) и путь к журналу на диске для переполнения.
+MQ_OUTBOX_SIZE = int(os.environ.get("MQ_OUTBOX_SIZE", "0"))
+MQ_OUTBOX_SPILL_PATH = os.environ.get("MQ_OUTBOX_SPILL_PATH")
 
 app = FastAPI()
 
 
+# Фоновые задачи старта. Ссылка на задачу нужна чтобы ее не собрал сборщик мусора,
+# а ошибка в ней попала в лог, а не потерялась вместе с задачей.
+background_tasks = set()
+
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.get_event_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(on_background_task_done)
+    return task
+
+
+def on_background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("Background task failed", exc_info=task.exception())
+
+
+async def cancel_background_tasks():
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
 @app.on_event('startup')
 async def start_message_consuming():
-    channel = await connect_to_broker()
-    mq.channel = rpc.channel = channel
+    # Подключение к брокеру идет в фоне и не блокирует старт приложения.
+    mq.pool = rpc.pool = create_pool()
+
+    # Одинаковые запросы к rpc_test_queue в течение 5 секунд отдаются из кэша.
+    rpc.enable_cache("rpc_test_queue", ttl=5, maxsize=256)
+
+    # Месседжи одного ключа попадают в один шард и обрабатываются по порядку.
+    mq.set_queue_shards("mq_sharded_queue", MQ_SHARDS)
+
+    # С outbox задержка HTTP-запросов не зависит от того медленный брокер или недоступен.
+    if MQ_OUTBOX_SIZE:
+        mq.enable_outbox(maxsize=MQ_OUTBOX_SIZE, policy="block", spill_path=MQ_OUTBOX_SPILL_PATH)
+
+    # Очередь ответов RPC объявляется один раз на старте, а не на каждый вызов.
+    run_in_background(rpc.setup_reply_queue())
+
+
+@app.on_event('shutdown')
+async def close_broker_connection():
+    await cancel_background_tasks()
+    # Оставшиеся в outbox месседжи отправляются до закрытия соединений.
+    await mq.close(timeout=10)
+    await mq.pool.close()
+    await close_client()
 
 
 @app.get("/users")
 async def get_users() -> dict:
     """Публичный EndPoint для работы по REST"""
-    users = requests.get("https://jsonplaceholder.typicode.com/users")
-    return users.json()
+    # Ответ берется из кэша, устаревшие данные обновляются в фоне через общий пул соединений.
+    return await cached_get_json("https://jsonplaceholder.typicode.com/users")
 
 
 @app.get("/mq_send_message")
@@ -33,6 +91,12 @@ async def mq_send_message():
     await mq.send(routing_key, "hello world")
 
 
+@app.get("/mq_send_keyed_message")
+async def mq_send_keyed_message(key: str):
+    """EndPoint для отправки сообщения в шардированную очередь сервиса B, порядок сохраняется внутри key."""
+    await mq.send("mq_sharded_queue", {"key": key, "text": "hello world"}, partition_key=key)
+
+
 @app.get("/rpc_send_message")
 async def rpc_send_message():
     """
@@ -48,5 +112,31 @@ async def rpc_send_message():
     return response
 
 
+@app.get("/rpc_stream_message")
+async def rpc_stream_message():
+    """
+    EndPoint для потокового вызова сервиса B.
+
+    Части ответа отдаются клиенту по мере прихода (NDJSON), не дожидаясь всего списка.
+    """
+    async def parts():
+        async for part in rpc.stream("rpc_stream_queue", size=20):
+            yield rpc.serialize(part) + b"\n"
+
+    return StreamingResponse(parts(), media_type="application/x-ndjson")
+
+
+@app.get("/rpc_cache_stats")
+async def rpc_cache_stats() -> dict:
+    """Счетчики кэша RPC-вызовов."""
+    return rpc.cache_stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики очередей и RPC в формате Prometheus."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 if __name__ == '__main__':
     uvicorn.run("main:app", host="127.0.0.1", port=7040, reload=True, log_level="debug")
@@ -0,0 +1,125 @@
+import json
+from typing import Any
+
+# Необязательные зависимости: кодеки на их основе доступны только если библиотека установлена.
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class Codec:
+    """Сериализация тела месседжа для определенного content_type."""
+
+    content_type = None
+    # Кодек передает словари, RPC передает через него именованные аргументы вызова.
+    structured = True
+
+    def encode(self, data: Any) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, body: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    """JSON через stdlib json."""
+
+    content_type = "application/json"
+
+    def encode(self, data: Any) -> bytes:
+        return json.dumps(data).encode()
+
+    def decode(self, body: bytes) -> Any:
+        return json.loads(body)
+
+
+class OrJSONCodec(JSONCodec):
+    """
+    JSON через orjson, подключается явно: register_codec(OrJSONCodec()) заменяет JSONCodec.
+
+    Принимает те же данные что и JSONCodec: нестроковые ключи словарей приводятся к строкам,
+    а datetime, dataclass и другие типы которые не умеет stdlib json отклоняются с TypeError.
+    Отличия: NaN и Infinity кодируются как null, не-ASCII символы пишутся как есть (UTF-8),
+    целые больше 64 бит не поддерживаются.
+    """
+
+    OPTIONS = (
+        orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if orjson is not None else 0
+    )
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError("orjson is not installed")
+
+    @staticmethod
+    def reject(data: Any):
+        raise TypeError(f"Object of type {type(data).__name__} is not JSON serializable")
+
+    def encode(self, data: Any) -> bytes:
+        return orjson.dumps(data, default=self.reject, option=self.OPTIONS)
+
+    def decode(self, body: bytes) -> Any:
+        return orjson.loads(body)
+
+
+class MsgPackCodec(Codec):
+    """Компактный бинарный формат msgpack."""
+
+    content_type = "application/msgpack"
+
+    def encode(self, data: Any) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, body: bytes) -> Any:
+        return msgpack.unpackb(body, raw=False)
+
+
+class RawCodec(Codec):
+    """Передача байтов как есть, без сериализации."""
+
+    content_type = "application/octet-stream"
+    structured = False
+
+    def encode(self, data: Any) -> bytes:
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            raise TypeError(f"{self.content_type} payload must be bytes, got {type(data).__name__}")
+        return bytes(data)
+
+    def decode(self, body: bytes) -> Any:
+        return body
+
+
+# Реестр кодеков по content_type.
+CODECS = {}
+
+DEFAULT_CONTENT_TYPE = JSONCodec.content_type
+
+
+def register_codec(codec: Codec):
+    """Регистрация кодека, уже зарегистрированный кодек для content_type будет заменен."""
+    CODECS[codec.content_type] = codec
+
+
+def get_codec(content_type: str = None) -> Codec:
+    """
+    Кодек для content_type.
+
+    Месседжи без content_type (например ответы RPC старых версий) считаются JSON.
+    """
+    try:
+        return CODECS[content_type or DEFAULT_CONTENT_TYPE]
+    except KeyError:
+        raise ValueError(f"No codec registered for content type: {content_type}") from None
+
+
+register_codec(JSONCodec())
+register_codec(RawCodec())
+if msgpack is not None:
+    register_codec(MsgPackCodec())
@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import nullcontext
+
+from aio_pika.message import IncomingMessage
+
+from . import metrics, tracing
+
+
+class QueueConsumer:
+    """
+    Слушатель одной очереди брокера с ограниченной параллельной обработкой.
+
+    Каждый месседж обрабатывается отдельной задачей, одновременно выполняется не более concurrency обработчиков.
+    Сколько месседжей брокер отдаст без подтверждения задается prefetch_count (basic_qos).
+
+    Если обработчик сам не подтвердил месседж, то после успешного выполнения он подтверждается (ack),
+    а при исключении отклоняется без возврата в очередь (reject). Если задан retry (Retrier), упавший месседж
+    вместо этого публикуется в очередь задержки или dead letter очередь, а исходный подтверждается.
+    При ordered_ack=True месседжи подтверждаются строго в порядке получения,
+    в этом режиме обработчик не должен сам вызывать ack.
+    """
+
+    def __init__(
+        self,
+        queue,
+        handler,
+        concurrency: int = 1,
+        prefetch_count: int = None,
+        ordered_ack: bool = False,
+        retry=None,
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency must be >= 1")
+
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.prefetch_count = prefetch_count if prefetch_count is not None else concurrency
+        self.ordered_ack = ordered_ack
+        self.retry = retry
+
+        self.channel = None  # Канал на котором запущен слушатель.
+        self.consumer_tag = None
+        self._semaphore = None
+        self._tasks = set()
+        self._pending_acks = deque()  # Месседжи в порядке получения для ordered_ack.
+
+    async def start(self, channel):
+        """Установка prefetch и подписка на очередь."""
+        self.channel = channel
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        # Без global_ prefetch применяется к слушателям созданным на канале после этого вызова,
+        # поэтому у каждой очереди остается свое значение даже на общем канале.
+        await channel.set_qos(prefetch_count=self.prefetch_count)
+        self.consumer_tag = await self.queue.consume(self.on_message)
+        logging.debug(f"Start to consuming queue {self.queue.name} with concurrency={self.concurrency}")
+
+    async def on_message(self, message: IncomingMessage):
+        """Вызывается aio-pika отдельной задачей на каждый полученный месседж."""
+        task = asyncio.current_task()
+        self._tasks.add(task)
+
+        entry = [message, None]  # [месседж, результат обработки]
+        if self.ordered_ack:
+            self._pending_acks.append(entry)
+
+        name = self.queue.name
+        # Спаны пишутся только если отправитель включил месседж в записываемую трассу.
+        parent = tracing.extract(message.headers)
+        try:
+            async with self._semaphore:
+                logging.debug(f'Received message body: {message.body}')
+                published_at = metrics.queue_wait(message.headers, name)
+                if parent is not None and published_at is not None:
+                    tracing.tracer.record("queue.wait", parent, published_at, queue=name)
+                metrics.in_flight.inc(name)
+                started = time.perf_counter()
+                status = "error"
+                try:
+                    with tracing.tracer.span("handle", parent, queue=name) if parent is not None else nullcontext():
+                        await self.handler(message)
+                    entry[1] = True
+                    status = "ok"
+                except Exception as e:
+                    logging.exception(f"Failed to process message from {name}")
+                    entry[1] = False
+                    if self.retry is not None and not message.processed:
+                        entry[1] = await self.reroute(message, e)
+                finally:
+                    elapsed = time.perf_counter() - started
+                    metrics.handler_seconds.observe(elapsed, name)
+                    metrics.consumed.inc(name, status)
+                    tracing.tracer.check_slow("handler for", name, elapsed)
+                    metrics.in_flight.dec(name)
+
+            if self.ordered_ack:
+                await self.settle_ordered()
+            else:
+                await self.settle(*entry)
+        finally:
+            self._tasks.discard(task)
+
+    async def reroute(self, message: IncomingMessage, error: Exception) -> bool:
+        """Отправка упавшего месседжа на повтор, возвращает True если исходный месседж можно подтвердить."""
+        try:
+            await self.retry.handle(message, f"{error.__class__.__name__}: {error}")
+            return True
+        except Exception:
+            logging.exception(f"Failed to reroute message from {self.queue.name}, returning it to the queue")
+            # Месседж не удалось переотправить, поэтому он возвращается в очередь чтобы не потеряться.
+            await message.nack(requeue=True)
+            return False
+
+    @staticmethod
+    async def settle(message: IncomingMessage, success: bool):
+        """Подтверждение или отклонение месседжа если обработчик не сделал этого сам."""
+        if message.processed:
+            return
+        if success:
+            await message.ack()
+        else:
+            await message.reject(requeue=False)
+
+    async def settle_ordered(self):
+        """Подтверждение всех готовых месседжей с начала очереди получения."""
+        while self._pending_acks and self._pending_acks[0][1] is not None:
+            message, success = self._pending_acks.popleft()
+            await self.settle(message, success)
+
+    async def close(self, timeout: float = None):
+        """
+        Остановка слушателя.
+
+        Сначала отменяется подписка чтобы брокер перестал присылать новые месседжи,
+        затем ожидается завершение уже полученных (не дольше timeout секунд).
+        """
+        if self.consumer_tag is not None:
+            await self.queue.cancel(self.consumer_tag)
+            self.consumer_tag = None
+
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+
+class BatchConsumer:
+    """
+    Слушатель очереди с обработкой месседжей пачками.
+
+    Месседжи собираются в пачку до batch_size штук, но не дольше batch_timeout секунд с момента
+    получения первого из них, после чего обработчик вызывается один раз со списком месседжей.
+    Обработчик может вернуть индексы неудачных месседжей, они отклоняются (nack) и при requeue_failed
+    возвращаются в очередь. Исключение в обработчике отклоняет всю пачку. Остальные месседжи подтверждаются
+    одним ack с multiple=True, обработчик не должен сам вызывать ack.
+
+    Если задан retry (Retrier), неудачные месседжи вместо возврата в очередь публикуются в очередь задержки
+    и подтверждаются вместе с остальными.
+
+    Пачки обрабатываются по одной и в порядке получения, следующая пачка собирается пока обрабатывается текущая.
+    Поэтому prefetch_count по умолчанию равен двум пачкам, при prefetch меньше batch_size пачка никогда не наполнится.
+
+    Ack с multiple подтверждает все неподтвержденные месседжи канала до указанного, поэтому он безопасен
+    только на отдельном канале слушателя. При multiple_ack=False месседжи подтверждаются по одному.
+    """
+
+    def __init__(
+        self,
+        queue,
+        handler,
+        batch_size: int = 100,
+        batch_timeout: float = 0.05,
+        prefetch_count: int = None,
+        requeue_failed: bool = True,
+        multiple_ack: bool = True,
+        retry=None,
+    ):
+        if batch_size < 1:
+            raise ValueError("batch_size must be >= 1")
+        if prefetch_count is not None and prefetch_count < batch_size:
+            raise ValueError("prefetch_count must be >= batch_size, otherwise a batch can't fill up")
+
+        self.queue = queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.prefetch_count = prefetch_count if prefetch_count is not None else batch_size * 2
+        self.requeue_failed = requeue_failed
+        self.multiple_ack = multiple_ack
+        self.retry = retry
+
+        self.channel = None  # Канал на котором запущен слушатель.
+        self.consumer_tag = None
+        self._buffer = None  # Полученные месседжи ожидающие попадания в пачку.
+        self._worker = None
+
+    async def start(self, channel):
+        """Установка prefetch, подписка на очередь и запуск сборки пачек."""
+        self.channel = channel
+        self._buffer = asyncio.Queue()
+        self._worker = asyncio.get_event_loop().create_task(self.run())
+
+        await channel.set_qos(prefetch_count=self.prefetch_count)
+        self.consumer_tag = await self.queue.consume(self.on_message)
+        logging.debug(f"Start to consuming queue {self.queue.name} with batch_size={self.batch_size}")
+
+    async def on_message(self, message: IncomingMessage):
+        self._buffer.put_nowait(message)
+
+    async def next_batch(self):
+        """
+        Сборка следующей пачки, возвращает пару (месседжи, остановлен ли слушатель).
+
+        Готовые месседжи забираются из буфера без ожидания, таймаут ставится только когда буфер пуст.
+        """
+        message = await self._buffer.get()
+        if message is None:
+            return [], True
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.batch_timeout
+        batch = [message]
+        while len(batch) < self.batch_size:
+            if self._buffer.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(self._buffer.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                message = self._buffer.get_nowait()
+
+            if message is None:
+                return batch, True
+            batch.append(message)
+        return batch, False
+
+    async def run(self):
+        while True:
+            batch, stopped = await self.next_batch()
+            if batch:
+                await self.process(batch)
+            if stopped:
+                return
+
+    async def process(self, batch: list):
+        name = self.queue.name
+        for message in batch:
+            metrics.queue_wait(message.headers, name)
+        metrics.batch_size.observe(len(batch), name)
+        metrics.in_flight.inc(name, amount=len(batch))
+        started = time.perf_counter()
+        error = "Rejected by batch handler"
+        try:
+            failed = set(await self.handler(batch) or ())
+        except Exception as e:
+            logging.exception(f"Failed to process batch of {len(batch)} messages from {name}")
+            failed = set(range(len(batch)))
+            error = f"{e.__class__.__name__}: {e}"
+        finally:
+            metrics.handler_seconds.observe(time.perf_counter() - started, name)
+            metrics.in_flight.dec(name, amount=len(batch))
+
+        metrics.consumed.inc(name, "ok", amount=len(batch) - len(failed))
+        if failed:
+            metrics.consumed.inc(name, "error", amount=len(failed))
+
+        try:
+            await self.settle(batch, failed, error)
+        except Exception:
+            # Например канал закрылся, неподтвержденные месседжи брокер вернет в очередь сам.
+            logging.exception(f"Failed to settle batch from {name}")
+
+    async def settle(self, batch: list, failed: set, error: str = None):
+        """Отклонение (или отправка на повтор) неудачных месседжей и подтверждение остальных."""
+        succeeded = []
+        for index, message in enumerate(batch):
+            if index not in failed:
+                succeeded.append(message)
+            elif self.retry is not None:
+                try:
+                    await self.retry.handle(message, error)
+                    succeeded.append(message)
+                except Exception:
+                    logging.exception(f"Failed to reroute message from {self.queue.name}, returning it to the queue")
+                    await message.nack(requeue=True)
+            else:
+                await message.nack(requeue=self.requeue_failed)
+
+        if not succeeded:
+            return
+        if self.multiple_ack:
+            # Неудачные месседжи уже отклонены, остальные до последнего успешного подтверждаются одним фреймом.
+            await succeeded[-1].ack(multiple=True)
+        else:
+            for message in succeeded:
+                await message.ack()
+
+    async def close(self, timeout: float = None):
+        """Отписка от очереди и обработка уже собранных месседжей (не дольше timeout секунд)."""
+        if self.consumer_tag is not None:
+            await self.queue.cancel(self.consumer_tag)
+            self.consumer_tag = None
+
+        if self._worker is not None:
+            self._buffer.put_nowait(None)
+            await asyncio.wait([self._worker], timeout=timeout)
+            self._worker = None
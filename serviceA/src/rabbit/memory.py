@@ -0,0 +1,425 @@
+"""
+Брокер в памяти процесса.
+
+Повторяет ту часть API aio-pika которую использует src/rabbit/server.py: соединение, каналы с set_qos,
+default_exchange.publish, declare_queue, consume/cancel, ack/nack/reject и amq.rabbitmq.reply-to.
+Нужен для бенчмарков и локальной проверки без RabbitMQ, подключается через RMQ_BACKEND=memory.
+"""
+import asyncio
+import copy
+import itertools
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+from aio_pika.message import Message
+
+DIRECT_REPLY_TO = "amq.rabbitmq.reply-to"
+
+
+def completed() -> asyncio.Future:
+    """Уже выполненный future, как Task который возвращают ack/nack/reject в aio-pika."""
+    future = asyncio.get_event_loop().create_future()
+    future.set_result(None)
+    return future
+
+
+class MemoryIncomingMessage:
+    """Аналог aio_pika.IncomingMessage."""
+
+    def __init__(self, message: Message, queue, consumer, delivery_tag: int, redelivered: bool, routing_key: str):
+        self.body = message.body
+        self.body_size = len(message.body)
+        self.headers = dict(message.headers or {})
+        self.content_type = message.content_type
+        self.content_encoding = message.content_encoding
+        self.delivery_mode = message.delivery_mode
+        self.priority = message.priority
+        self.correlation_id = message.correlation_id
+        self.reply_to = message.reply_to
+        self.expiration = message.expiration
+        self.message_id = message.message_id
+        self.timestamp = message.timestamp
+        self.type = message.type
+        self.user_id = message.user_id
+        self.app_id = message.app_id
+        self.routing_key = routing_key
+        self.exchange = ""
+        self.delivery_tag = delivery_tag
+        self.redelivered = redelivered
+        self.consumer_tag = consumer.tag if consumer else None
+
+        self.source = message  # Исходный месседж для повторной доставки.
+        self.queue = queue
+        self.consumer = consumer
+        self.no_ack = consumer.no_ack if consumer else False
+        self._processed = self.no_ack
+
+    @property
+    def processed(self) -> bool:
+        return self._processed
+
+    def _settle(self):
+        if self.no_ack:
+            raise TypeError("Can't ack message with \"no_ack\" flag")
+        if self._processed:
+            raise RuntimeError("Message already processed")
+        self._processed = True
+
+    def ack(self, multiple: bool = False) -> asyncio.Future:
+        self._settle()
+        self.consumer.channel.settle(self, multiple=multiple, requeue=None)
+        return completed()
+
+    def nack(self, multiple: bool = False, requeue: bool = True) -> asyncio.Future:
+        self._settle()
+        self.consumer.channel.settle(self, multiple=multiple, requeue=requeue)
+        return completed()
+
+    def reject(self, requeue: bool = False) -> asyncio.Future:
+        self._settle()
+        self.consumer.channel.settle(self, multiple=False, requeue=requeue)
+        return completed()
+
+    @asynccontextmanager
+    async def process(self, requeue: bool = False, reject_on_redelivered: bool = False, ignore_processed: bool = False):
+        try:
+            yield self
+            if not ignore_processed or not self.processed:
+                await self.ack()
+        except Exception:
+            if not ignore_processed or not self.processed:
+                await self.reject(requeue=requeue and not (reject_on_redelivered and self.redelivered))
+            raise
+
+    def info(self) -> dict:
+        return dict(
+            body_size=self.body_size,
+            headers=self.headers,
+            content_type=self.content_type,
+            content_encoding=self.content_encoding,
+            correlation_id=self.correlation_id,
+            reply_to=self.reply_to,
+            delivery_tag=self.delivery_tag,
+            redelivered=self.redelivered,
+            routing_key=self.routing_key,
+        )
+
+
+class MemoryConsumer:
+    def __init__(self, queue: "MemoryQueueState", channel, callback, no_ack: bool, tag: str):
+        self.queue = queue
+        self.channel = channel
+        self.callback = callback
+        self.no_ack = no_ack
+        self.tag = tag
+        self.prefetch_count = channel.prefetch_count
+        self.unacked = 0
+
+    @property
+    def has_capacity(self) -> bool:
+        return not self.prefetch_count or self.unacked < self.prefetch_count
+
+
+class MemoryQueueState:
+    """Состояние очереди: хранит месседжи и раздает их слушателям по кругу с учетом prefetch."""
+
+    def __init__(self, broker, name: str, durable=False, exclusive=False, auto_delete=False, arguments=None):
+        self.broker = broker
+        self.name = name
+        self.durable = durable
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.arguments = arguments or {}
+        self.messages = deque()  # (Message, redelivered)
+        self.consumers = {}  # consumer_tag -> MemoryConsumer
+        self._round_robin = itertools.cycle([])
+
+    def __repr__(self):
+        return f"<MemoryQueueState({self.name}): {len(self.messages)} messages, {len(self.consumers)} consumers>"
+
+    def put(self, message: Message, redelivered: bool = False, front: bool = False):
+        if front:
+            self.messages.appendleft((message, redelivered))
+        else:
+            self.messages.append((message, redelivered))
+
+        ttl = self.arguments.get("x-message-ttl")
+        if ttl is not None:
+            asyncio.get_event_loop().call_later(ttl / 1000, self.expire, message)
+        self.dispatch()
+
+    def expire(self, message: Message):
+        """Месседж не полученный за x-message-ttl удаляется и отправляется в dead letter exchange очереди."""
+        for index, (queued, _) in enumerate(self.messages):
+            if queued is message:
+                del self.messages[index]
+                self.broker.dead_letter(self, message, self.name)
+                return
+
+    def dispatch(self):
+        """Доставка ожидающих месседжей слушателям у которых есть свободный prefetch."""
+        while self.messages and self.consumers:
+            consumer = self.next_consumer()
+            if consumer is None:
+                return
+            message, redelivered = self.messages.popleft()
+            consumer.channel.deliver(consumer, message, redelivered, self.name)
+
+    def next_consumer(self):
+        for _ in range(len(self.consumers)):
+            consumer = next(self._round_robin)
+            if consumer.has_capacity and not consumer.channel.is_closed:
+                return consumer
+        return None
+
+    def add_consumer(self, consumer):
+        self.consumers[consumer.tag] = consumer
+        self._round_robin = itertools.cycle(list(self.consumers.values()))
+        self.dispatch()
+
+    def remove_consumer(self, consumer_tag: str):
+        self.consumers.pop(consumer_tag, None)
+        self._round_robin = itertools.cycle(list(self.consumers.values()))
+        if self.auto_delete and not self.consumers:
+            self.broker.delete_queue(self.name)
+
+
+class MemoryQueue:
+    """Аналог aio_pika.Queue: очередь объявленная на конкретном канале."""
+
+    def __init__(self, state: MemoryQueueState, channel):
+        self.state = state
+        self.channel = channel
+        self.name = state.name
+        self.durable = state.durable
+        self.exclusive = state.exclusive
+        self.auto_delete = state.auto_delete
+        self.arguments = state.arguments
+        self._consumers = {}  # Слушатели созданные через этот объект, как в aio-pika.
+
+    def __repr__(self):
+        return f"<MemoryQueue({self.name}): {len(self.state.messages)} messages>"
+
+    @property
+    def message_count(self) -> int:
+        return len(self.state.messages)
+
+    async def consume(self, callback, no_ack: bool = False, exclusive: bool = False, arguments=None,
+                      consumer_tag=None, timeout=None) -> str:
+        tag = consumer_tag or f"ctag.{uuid4().hex}"
+        consumer = MemoryConsumer(self.state, self.channel, callback, no_ack, tag)
+        self._consumers[tag] = consumer
+        self.state.add_consumer(consumer)
+        return tag
+
+    async def cancel(self, consumer_tag: str, timeout=None, nowait: bool = False):
+        self._consumers.pop(consumer_tag, None)
+        self.state.remove_consumer(consumer_tag)
+
+    async def purge(self, no_wait: bool = False, timeout=None):
+        count = len(self.state.messages)
+        self.state.messages.clear()
+        return count
+
+    async def delete(self, *, if_unused: bool = False, if_empty: bool = False, timeout=None):
+        self.state.broker.delete_queue(self.name)
+
+
+class MemoryExchange:
+    """Аналог дефолтного exchange: routing_key это название очереди."""
+
+    name = ""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def publish(self, message: Message, routing_key: str, *, mandatory: bool = True, immediate: bool = False,
+                      timeout=None):
+        if self.channel.is_closed:
+            raise RuntimeError("Channel is closed")
+
+        # Месседж копируется чтобы один и тот же объект можно было публиковать несколько раз.
+        message = copy.copy(message)
+        if message.reply_to == DIRECT_REPLY_TO:
+            message.reply_to = self.channel.direct_reply_name
+
+        self.channel.broker.route(message, routing_key)
+        # Канал работает как канал с publisher confirms: публикация завершается после подтверждения.
+        await asyncio.sleep(0)
+
+
+class MemoryChannel:
+    """Аналог aio_pika.Channel."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, connection, publisher_confirms: bool = True):
+        self.connection = connection
+        self._connection = connection  # Как в aio_pika.Channel.
+        self.broker = connection.broker
+        self.loop = asyncio.get_event_loop()
+        self.number = next(self._ids)
+        self.publisher_confirms = publisher_confirms
+        self.default_exchange = MemoryExchange(self)
+        self.prefetch_count = 0
+        self.is_closed = False
+        self.direct_reply_name = f"{DIRECT_REPLY_TO}.{self.number}"
+        self.delivery_tags = itertools.count(1)
+        self.unacked = {}  # delivery_tag -> MemoryIncomingMessage
+        self.exclusive_queues = []
+
+    def __repr__(self):
+        return f"<MemoryChannel #{self.number}>"
+
+    async def set_qos(self, prefetch_count: int = 0, prefetch_size: int = 0, global_: bool = False, timeout=None,
+                      all_channels: bool = False):
+        # Как в RabbitMQ: prefetch применяется к слушателям созданным после вызова.
+        self.prefetch_count = prefetch_count
+
+    async def declare_queue(self, name: str = None, *, durable: bool = False, exclusive: bool = False,
+                            passive: bool = False, auto_delete: bool = False, arguments: dict = None, timeout=None):
+        if name == DIRECT_REPLY_TO:
+            return self.broker.direct_reply_queue(self)
+
+        name = name or f"amq.gen-{uuid4().hex}"
+        state = self.broker.queues.get(name)
+        if state is None:
+            if passive:
+                raise LookupError(f"NOT_FOUND - no queue '{name}'")
+            state = MemoryQueueState(self.broker, name, durable, exclusive, auto_delete, arguments)
+            self.broker.queues[name] = state
+            if exclusive:
+                self.exclusive_queues.append(name)
+        return MemoryQueue(state, self)
+
+    async def get_queue(self, name: str, *, ensure: bool = True):
+        return await self.declare_queue(name, passive=True)
+
+    def deliver(self, consumer: MemoryConsumer, message: Message, redelivered: bool, routing_key: str):
+        incoming = MemoryIncomingMessage(
+            message, consumer.queue, consumer, next(self.delivery_tags), redelivered, routing_key,
+        )
+        if not consumer.no_ack:
+            consumer.unacked += 1
+            self.unacked[incoming.delivery_tag] = incoming
+
+        # Как в aio-pika каждый месседж обрабатывается отдельной задачей.
+        result = consumer.callback(incoming)
+        if asyncio.iscoroutine(result):
+            self.loop.create_task(result)
+
+    def settle(self, message: MemoryIncomingMessage, multiple: bool, requeue):
+        """ack (requeue=None), nack или reject месседжа, при multiple - всех неподтвержденных до него."""
+        if multiple:
+            tags = [tag for tag in self.unacked if tag <= message.delivery_tag]
+        else:
+            tags = [message.delivery_tag]
+
+        queues = set()
+        for tag in tags:
+            incoming = self.unacked.pop(tag, None)
+            if incoming is None:
+                continue
+            incoming._processed = True
+            incoming.consumer.unacked -= 1
+            queues.add(incoming.queue)
+            if requeue:
+                incoming.queue.put(incoming.source, redelivered=True, front=True)
+            elif requeue is not None:
+                self.broker.dead_letter(incoming.queue, incoming.source, incoming.routing_key)
+
+        for queue in queues:
+            queue.dispatch()
+
+    async def close(self, exc=None):
+        if self.is_closed:
+            return
+        self.is_closed = True
+
+        # Неподтвержденные месседжи возвращаются в свои очереди.
+        unacked, self.unacked = self.unacked, {}
+        for incoming in sorted(unacked.values(), key=lambda item: item.delivery_tag, reverse=True):
+            incoming.consumer.unacked -= 1
+            incoming.queue.put(incoming.source, redelivered=True, front=True)
+
+        states = list(self.broker.queues.values()) + list(self.broker.direct_reply_queues.values())
+        for state in states:
+            for tag, consumer in list(state.consumers.items()):
+                if consumer.channel is self:
+                    state.remove_consumer(tag)
+
+        for name in self.exclusive_queues:
+            self.broker.delete_queue(name)
+        self.broker.direct_reply_queues.pop(self.direct_reply_name, None)
+
+
+class MemoryConnection:
+    """Аналог aio_pika.RobustConnection."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = []
+        self.is_closed = False
+
+    def __repr__(self):
+        return f"<MemoryConnection: {len(self.channels)} channels>"
+
+    async def channel(self, channel_number: int = None, publisher_confirms: bool = True,
+                      on_return_raises: bool = False) -> MemoryChannel:
+        channel = MemoryChannel(self, publisher_confirms)
+        self.channels.append(channel)
+        return channel
+
+    async def close(self, exc=None):
+        self.is_closed = True
+        for channel in self.channels:
+            await channel.close()
+
+
+class MemoryBroker:
+    """Состояние брокера: очереди общие для всех соединений процесса."""
+
+    def __init__(self):
+        self.queues = {}
+        self.direct_reply_queues = {}  # amq.rabbitmq.reply-to.<channel> -> MemoryQueueState
+        self.published = 0
+        self.unroutable = 0
+
+    def route(self, message: Message, routing_key: str):
+        self.published += 1
+        queue = self.queues.get(routing_key) or self.direct_reply_queues.get(routing_key)
+        if queue is None:
+            self.unroutable += 1
+            logging.debug(f"Message to {routing_key} was not routed")
+            return
+        queue.put(message)
+
+    def direct_reply_queue(self, channel: MemoryChannel) -> MemoryQueue:
+        state = self.direct_reply_queues.get(channel.direct_reply_name)
+        if state is None:
+            state = MemoryQueueState(self, DIRECT_REPLY_TO, exclusive=True)
+            self.direct_reply_queues[channel.direct_reply_name] = state
+        return MemoryQueue(state, channel)
+
+    def dead_letter(self, queue: MemoryQueueState, message: Message, routing_key: str):
+        """Отклоненный без возврата или истекший месседж отправляется в x-dead-letter-exchange очереди если он задан."""
+        arguments = queue.arguments
+        if "x-dead-letter-exchange" not in arguments:
+            return
+        self.route(message, arguments.get("x-dead-letter-routing-key", routing_key))
+
+    def delete_queue(self, name: str):
+        self.queues.pop(name, None)
+
+    async def connect(self) -> MemoryConnection:
+        return MemoryConnection(self)
+
+
+# Один брокер на процесс, как один RabbitMQ на docker-compose.
+BROKER = MemoryBroker()
+
+
+async def connect(url: str = "memory://") -> MemoryConnection:
+    return await BROKER.connect()
@@ -0,0 +1,325 @@
+"""
+Локальный outbox для публикации в брокер.
+
+send кладет месседж в очередь в памяти и сразу возвращает управление, а фоновая задача публикует
+накопленные месседжи пачками когда брокер доступен. Тем самым медленный или недоступный брокер
+не задерживает обработку HTTP-запросов. Доставка at-least-once: после ошибки публикации пачка
+отправляется повторно целиком, поэтому получатель может получить месседж дважды.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+from collections import deque
+
+from aio_pika.message import Message
+
+from . import metrics
+from .pool import backoff_delays
+
+
+class OutboxFull(Exception):
+    """Outbox заполнен и выбрана политика raise."""
+
+    def __init__(self, maxsize: int):
+        super().__init__(f"Outbox is full ({maxsize} messages)")
+        self.maxsize = maxsize
+
+
+class SpillLog:
+    """
+    Append-only журнал месседжей на диске, одна JSON-строка на месседж.
+
+    Месседжи читаются с начала журнала по порядку, но удаляются из него только через commit,
+    после того как брокер подтвердил их публикацию. Когда удалены все - файл очищается.
+    Если процесс завершился не опустошив журнал, при следующем запуске его месседжи будут отправлены заново.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "ab")
+        self.read_offset = 0  # Начало первого неподтвержденного месседжа.
+        self.read_ends = []  # Смещения концов месседжей прочитанных последним read.
+        self.pending = 0
+        if os.path.getsize(path):
+            with open(path, "rb") as file:
+                self.pending = sum(1 for line in file if line.strip())
+
+    def append(self, routing_key: str, message: Message):
+        record = dict(
+            routing_key=routing_key,
+            body=base64.b64encode(message.body).decode(),
+            content_type=message.content_type,
+            content_encoding=message.content_encoding,
+            correlation_id=message.correlation_id,
+            reply_to=message.reply_to,
+            message_id=message.message_id,
+            priority=message.priority,
+            delivery_mode=int(message.delivery_mode) if message.delivery_mode else None,
+            headers=dict(message.headers or {}),
+        )
+        self.file.write(json.dumps(record).encode() + b"\n")
+        self.file.flush()
+        self.pending += 1
+
+    def read(self, count: int) -> list:
+        """
+        Первые count неподтвержденных месседжей журнала в виде пар (routing_key, Message).
+
+        Повторный read без commit вернет те же месседжи.
+        """
+        items = []
+        self.read_ends = []
+        with open(self.path, "rb") as file:
+            file.seek(self.read_offset)
+            while len(items) < count:
+                line = file.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                message = Message(
+                    body=base64.b64decode(record["body"]),
+                    content_type=record["content_type"],
+                    content_encoding=record["content_encoding"],
+                    correlation_id=record["correlation_id"],
+                    reply_to=record.get("reply_to"),
+                    message_id=record.get("message_id"),
+                    priority=record.get("priority"),
+                    delivery_mode=record.get("delivery_mode"),
+                    headers=record["headers"],
+                )
+                items.append((record["routing_key"], message))
+                self.read_ends.append(file.tell())
+        return items
+
+    def commit(self, count: int):
+        """Удаление из журнала первых count месседжей прочитанных последним read."""
+        if not count:
+            return
+        self.read_offset = self.read_ends[count - 1]
+        self.read_ends = []
+        self.pending = max(0, self.pending - count)
+        if not self.pending:
+            self.file.truncate(0)
+            self.read_offset = 0
+
+    def close(self):
+        self.file.close()
+
+
+class Outbox:
+    """
+    Ограниченная очередь публикаций в памяти с фоновой отправкой пачками.
+
+    Когда в памяти maxsize месседжей, срабатывает политика:
+    block - send ждет пока освободится место, drop_oldest - удаляется самый старый месседж,
+    raise - поднимается OutboxFull. Если задан spill_path, вместо политики месседжи дописываются
+    в журнал на диске и отправляются после месседжей из памяти, порядок публикации при этом сохраняется.
+    Месседжи из памяти занимают место в outbox пока брокер не подтвердит их публикацию,
+    поэтому возврат неотправленной пачки не превышает maxsize.
+    """
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    RAISE = "raise"
+    POLICIES = (BLOCK, DROP_OLDEST, RAISE)
+
+    def __init__(
+        self,
+        client,
+        maxsize: int = 10000,
+        policy: str = BLOCK,
+        batch_size: int = 256,
+        spill_path: str = None,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+    ):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown outbox policy: {policy}")
+        if maxsize < 1 or batch_size < 1:
+            raise ValueError("maxsize and batch_size must be >= 1")
+
+        self.client = client  # MessageQueue через который публикуются месседжи.
+        self.maxsize = maxsize
+        self.policy = policy
+        self.batch_size = batch_size
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.spill = SpillLog(spill_path) if spill_path else None
+
+        self.items = deque()  # Пары (routing_key, Message) в порядке публикации.
+        self.in_flight = 0  # Месседжи из памяти которые публикуются сейчас.
+        self.closing = False
+        self._not_empty = None
+        self._not_full = None
+        self._task = None
+
+    @property
+    def depth(self) -> int:
+        return len(self.items) + (self.spill.pending if self.spill is not None else 0)
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.items) + self.in_flight >= self.maxsize
+
+    def start(self) -> asyncio.Task:
+        if self._task is None:
+            self._not_empty = asyncio.Event()
+            self._not_full = asyncio.Event()
+            self._not_full.set()
+            if self.depth:
+                self._not_empty.set()
+            self._task = asyncio.get_event_loop().create_task(self.run())
+        return self._task
+
+    async def put(self, routing_key: str, message: Message):
+        if self.closing:
+            raise RuntimeError("Outbox is closed")
+        self.start()
+
+        if self.spill is not None and (self.spill.pending or self.is_full):
+            # Пока в журнале есть месседжи, новые тоже идут в журнал, иначе они обгонят старые.
+            self.spill.append(routing_key, message)
+            metrics.outbox_messages.inc("spilled")
+        else:
+            if self.is_full:
+                if self.policy == self.RAISE:
+                    metrics.outbox_messages.inc("rejected")
+                    raise OutboxFull(self.maxsize)
+                if self.policy == self.DROP_OLDEST:
+                    if not self.items:
+                        # Все место занято публикуемой пачкой, отбросить можно только новый месседж.
+                        metrics.outbox_messages.inc("dropped")
+                        return
+                    self.items.popleft()
+                    metrics.outbox_messages.inc("dropped")
+                else:
+                    while self.is_full:
+                        self._not_full.clear()
+                        await self._not_full.wait()
+
+            self.items.append((routing_key, message))
+            metrics.outbox_messages.inc("queued")
+
+        self._not_empty.set()
+        self.update_metrics()
+
+    def take(self) -> tuple:
+        """
+        Следующая пачка: сначала из памяти, затем из журнала на диске.
+
+        Возвращает пару (batch, spilled), spilled=True если пачка прочитана из журнала.
+        """
+        batch = []
+        while self.items and len(batch) < self.batch_size:
+            batch.append(self.items.popleft())
+        if batch:
+            self.in_flight = len(batch)
+            return batch, False
+        if self.spill is not None and self.spill.pending:
+            return self.spill.read(self.batch_size), True
+        return batch, False
+
+    def requeue(self, items: list):
+        """Возврат неотправленных месседжей в начало очереди, их место в outbox еще занято (in_flight)."""
+        self.items.extendleft(reversed(items))
+        self.update_metrics()
+
+    def release(self):
+        """Освобождение места занятого публикуемой пачкой из памяти."""
+        self.in_flight = 0
+        if not self.is_full:
+            self._not_full.set()
+
+    async def run(self):
+        delays = backoff_delays(self.base_delay, self.max_delay)
+        while True:
+            if self.client.pool is not None:
+                await self.client.pool.wait_ready()
+
+            batch, spilled = self.take()
+            if not batch:
+                if self.closing:
+                    return
+                self._not_empty.clear()
+                await self._not_empty.wait()
+                continue
+
+            try:
+                await self.flush(batch, spilled)
+                delays = backoff_delays(self.base_delay, self.max_delay)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = next(delays)
+                logging.warning(f"Outbox flush failed ({e!r}), {self.depth} message(s) pending, "
+                                f"retrying in {delay:.1f} seconds")
+                await asyncio.sleep(delay)
+
+    async def flush(self, batch: list, spilled: bool = False):
+        """
+        Публикация пачки группами подряд идущих месседжей в одну очередь.
+
+        Неподтвержденные брокером месседжи из памяти возвращаются в начало очереди, а из журнала (spilled=True)
+        удаляются только месседжи до первого неподтвержденного, остальные будут прочитаны заново.
+        """
+        start = end = 0
+        failed = []
+        try:
+            while start < len(batch):
+                routing_key = batch[start][0]
+                end = start
+                while end < len(batch) and batch[end][0] == routing_key:
+                    end += 1
+
+                messages = [message for _, message in batch[start:end]]
+                failed = [start + index for index in await self.client.publish_many(routing_key, messages)]
+                if failed:
+                    raise RuntimeError(f"{len(failed)} message(s) to {routing_key} were not confirmed by broker")
+
+                metrics.outbox_messages.inc("flushed", amount=len(messages))
+                start = end
+        finally:
+            # Остальные месседжи группы с неподтвержденными уже опубликованы.
+            unsent = failed + list(range(end, len(batch))) if failed else list(range(start, len(batch)))
+            if spilled:
+                self.spill.commit(unsent[0] if unsent else len(batch))
+            else:
+                self.requeue([batch[index] for index in unsent])
+                self.release()
+            self.update_metrics()
+
+    def update_metrics(self):
+        metrics.outbox_depth.set(len(self.items), "memory")
+        if self.spill is not None:
+            metrics.outbox_depth.set(self.spill.pending, "disk")
+
+    async def close(self, timeout: float = None):
+        """
+        Отправка оставшихся месседжей (не дольше timeout секунд).
+
+        Не отправленные месседжи из памяти дописываются в журнал на диске если он задан, иначе теряются.
+        """
+        self.closing = True
+        if self._task is not None:
+            self._not_empty.set()
+            done, _ = await asyncio.wait([self._task], timeout=timeout)
+            if not done:
+                self._task.cancel()
+                await asyncio.wait([self._task])
+            self._task = None
+
+        if self.items:
+            if self.spill is not None:
+                for routing_key, message in self.items:
+                    self.spill.append(routing_key, message)
+            else:
+                logging.warning(f"Outbox closed with {len(self.items)} unsent message(s)")
+            self.items.clear()
+
+        if self.spill is not None:
+            self.spill.close()
+        self.update_metrics()
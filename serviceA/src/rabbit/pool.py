@@ -0,0 +1,166 @@
+import asyncio
+import itertools
+import random
+from contextlib import asynccontextmanager
+
+import aio_pika
+from aio_pika.channel import Channel
+
+from . import memory
+
+
+def backoff_delays(base: float = 0.5, maximum: float = 30.0):
+    """Бесконечная последовательность задержек экспоненциального backoff с полным jitter."""
+    for attempt in itertools.count():
+        yield random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+async def connect_with_retry(url: str, base_delay: float = 0.5, max_delay: float = 30.0, **kwargs):
+    """
+    Подключение к брокеру с повторными попытками.
+
+    Между попытками выполняется asyncio.sleep, поэтому ожидание не блокирует event loop.
+    После первого успешного подключения переподключением занимается сам RobustConnection.
+    Адрес вида memory:// подключает к брокеру в памяти процесса (rabbit.memory).
+    """
+    if url.startswith("memory://"):
+        return await memory.connect(url)
+
+    delays = backoff_delays(base_delay, max_delay)
+    retries = 0
+    while True:
+        try:
+            return await aio_pika.connect_robust(url, **kwargs)
+        except Exception as e:
+            retries += 1
+            delay = next(delays)
+            print(f"Can't connect to broker {retries} time({e.__class__.__name__}:{e}). Will retry in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+
+
+class ChannelPool:
+    """
+    Пул соединений и каналов к брокеру.
+
+    Публикация идет через пул каналов издателей: acquire выдает наименее загруженный канал,
+    поэтому медленная публикация (например при flow control) задерживает только свой канал.
+    Каждый слушатель получает собственный канал через consumer_channel,
+    тем самым prefetch и медленные обработчики одной очереди не влияют на другие.
+    При connections > 1 каналы распределяются по нескольким соединениям.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        connections: int = 1,
+        publisher_channels: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+    ):
+        if connections < 1 or publisher_channels < 1:
+            raise ValueError("connections and publisher_channels must be >= 1")
+
+        self.url = url
+        self.size = connections
+        self.publisher_size = publisher_channels
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.connections = []
+        self.publishers = []
+        self._in_use = {}  # id канала издателя -> количество задач которые его используют.
+        self._consumer_channels = []
+        self._next_connection = itertools.count()
+        self._ready = None
+        self._connect_task = None
+
+    @property
+    def ready(self) -> asyncio.Event:
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        return self._ready
+
+    def start(self) -> asyncio.Task:
+        """Подключение в фоне, не блокирует старт приложения. Завершившееся ошибкой подключение запускается заново."""
+        task = self._connect_task
+        if task is None or (task.done() and not self.ready.is_set()):
+            self._connect_task = asyncio.get_event_loop().create_task(self.connect())
+        return self._connect_task
+
+    async def connect(self):
+        """Открытие соединений и каналов издателей, при ошибке попытка повторяется с backoff."""
+        delays = backoff_delays(self.base_delay, self.max_delay)
+        while not self.ready.is_set():
+            try:
+                await self.open()
+            except Exception as e:
+                delay = next(delays)
+                print(f"Can't open channels to broker ({e.__class__.__name__}:{e}). Will retry in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+                continue
+            self.ready.set()
+
+    async def open(self):
+        # Закрытые соединения и каналы (например после неудачной попытки) открываются заново.
+        self.connections = [connection for connection in self.connections if not connection.is_closed]
+        self.publishers = [channel for channel in self.publishers if not channel.is_closed]
+        self._in_use = {id(channel): self._in_use.get(id(channel), 0) for channel in self.publishers}
+
+        for _ in range(self.size - len(self.connections)):
+            connection = await connect_with_retry(self.url, self.base_delay, self.max_delay)
+            print(f"Connected to broker ({type(connection)} ID {id(connection)})")
+            self.connections.append(connection)
+
+        for _ in range(self.publisher_size - len(self.publishers)):
+            channel = await self.next_connection().channel()
+            self.publishers.append(channel)
+            self._in_use[id(channel)] = 0
+
+    async def wait_ready(self):
+        """Ожидание подключения, ошибка подключения поднимается здесь же, а не оставляет вызывающих ждать вечно."""
+        task = self.start()
+        if not self.ready.is_set():
+            await asyncio.shield(task)
+
+    def next_connection(self):
+        return self.connections[next(self._next_connection) % len(self.connections)]
+
+    @asynccontextmanager
+    async def acquire(self) -> Channel:
+        """Выдача канала издателя на время публикации."""
+        await self.wait_ready()
+        channel = min(self.publishers, key=lambda item: self._in_use[id(item)])
+        self._in_use[id(channel)] += 1
+        try:
+            yield channel
+        finally:
+            self._in_use[id(channel)] -= 1
+
+    async def consumer_channel(self) -> Channel:
+        """Отдельный канал для слушателя очереди."""
+        await self.wait_ready()
+        channel = await self.next_connection().channel()
+        self._consumer_channels.append(channel)
+        return channel
+
+    async def release_channel(self, channel: Channel):
+        """Закрытие канала слушателя когда он больше не нужен (слушатель остановлен)."""
+        if channel in self._consumer_channels:
+            self._consumer_channels.remove(channel)
+        if not channel.is_closed:
+            await channel.close()
+
+    async def close(self):
+        if self._connect_task is not None and not self._connect_task.done():
+            self._connect_task.cancel()
+
+        for channel in list(self._consumer_channels):
+            await self.release_channel(channel)
+        for connection in self.connections:
+            await connection.close()
+
+        self.connections, self.publishers, self._consumer_channels = [], [], []
+        self._in_use = {}
+        self._connect_task = None
+        if self._ready is not None:
+            self._ready.clear()
@@ -0,0 +1,115 @@
+"""
+Повторная обработка месседжей с задержкой.
+
+Месседж, обработчик которого упал, не возвращается в свою очередь (это дало бы мгновенную повторную доставку
+и горячий цикл), а публикуется в очередь задержки {queue}.retry.{миллисекунды}. У каждой очереди задержки
+свой x-message-ttl, по истечении которого брокер через dead letter exchange возвращает месседж в исходную очередь.
+Раз в очереди задержки все месседжи живут одинаково, они истекают строго по порядку и не ждут друг друга.
+Номер попытки хранится в заголовке x-retry-attempt, после max_retries попыток месседж уходит в {queue}.dlq.
+"""
+import logging
+import time
+
+from aio_pika.message import IncomingMessage, Message
+
+from . import metrics
+
+ATTEMPT_HEADER = "x-retry-attempt"  # Сколько раз месседж уже был отправлен на повтор.
+ERROR_HEADER = "x-retry-error"  # Текст последней ошибки обработчика.
+MAX_ERROR_LENGTH = 1024
+
+
+def delay_queue_name(queue_name: str, delay: float) -> str:
+    return f"{queue_name}.retry.{int(delay * 1000)}"
+
+
+def dead_letter_queue_name(queue_name: str) -> str:
+    return f"{queue_name}.dlq"
+
+
+class RetryPolicy:
+    """Экспоненциальная задержка повторов: base_delay * factor ** попытка, но не больше max_delay секунд."""
+
+    def __init__(self, max_retries: int = 5, base_delay: float = 1.0, factor: float = 2.0, max_delay: float = 300.0):
+        if max_retries < 0:
+            raise ValueError("max_retries must be >= 0")
+        if base_delay <= 0:
+            # Очередь задержки с нулевым TTL вернула бы месседж сразу, то есть тот же горячий цикл.
+            raise ValueError("base_delay must be > 0")
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.factor = factor
+        self.max_delay = max_delay
+
+    def delay_for(self, attempt: int) -> float:
+        """Задержка перед повтором номер attempt (начиная с 0)."""
+        # Округление до миллисекунд чтобы одинаковые задержки попадали в одну очередь.
+        return round(min(self.max_delay, self.base_delay * self.factor ** attempt), 3)
+
+    def delays(self) -> list:
+        """Различные задержки, по одной очереди задержки на каждую."""
+        return sorted({self.delay_for(attempt) for attempt in range(self.max_retries)})
+
+
+class Retrier:
+    """Перенаправление упавших месседжей очереди queue_name в очереди задержки и в dead letter очередь."""
+
+    def __init__(self, client, queue_name: str, policy: RetryPolicy):
+        self.client = client  # BaseRMQ через который публикуются месседжи.
+        self.queue_name = queue_name
+        self.policy = policy
+
+    async def declare(self, channel):
+        """Объявление очередей задержки и dead letter очереди."""
+        await channel.declare_queue(dead_letter_queue_name(self.queue_name), durable=True)
+        for delay in self.policy.delays():
+            await channel.declare_queue(
+                delay_queue_name(self.queue_name, delay),
+                durable=True,
+                arguments={
+                    "x-message-ttl": int(delay * 1000),
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": self.queue_name,
+                },
+            )
+
+    async def handle(self, message: IncomingMessage, error: str):
+        """
+        Публикация копии месседжа в очередь задержки или в dead letter очередь.
+
+        После успешной публикации исходный месседж нужно подтвердить (ack).
+        """
+        headers = dict(message.headers or {})
+        attempt = int(headers.get(ATTEMPT_HEADER, 0))
+        headers[ERROR_HEADER] = error[:MAX_ERROR_LENGTH]
+
+        if attempt >= self.policy.max_retries:
+            routing_key = dead_letter_queue_name(self.queue_name)
+            status = "dead_lettered"
+            logging.warning(f"Message {message.correlation_id} from {self.queue_name} is dead-lettered "
+                            f"after {attempt} retries: {error}")
+        else:
+            delay = self.policy.delay_for(attempt)
+            routing_key = delay_queue_name(self.queue_name, delay)
+            headers[ATTEMPT_HEADER] = attempt + 1
+            # Время ожидания в очереди считается с момента возврата месседжа из очереди задержки.
+            headers[metrics.PUBLISHED_AT_HEADER] = time.time() + delay
+            status = "retried"
+
+        await self.client.publish(
+            Message(
+                body=message.body,
+                content_type=message.content_type,
+                content_encoding=message.content_encoding,
+                correlation_id=message.correlation_id,
+                reply_to=message.reply_to,
+                delivery_mode=message.delivery_mode,
+                message_id=message.message_id,
+                priority=message.priority,
+                timestamp=message.timestamp,
+                type=message.type,
+                headers=headers,
+            ),
+            routing_key,
+        )
+        metrics.retries.inc(self.queue_name, status)
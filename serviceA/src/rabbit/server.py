@@ -3,70 +3,517 @@ import logging
 
 import os
 import copy
-import json
+import inspect
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Any
 from uuid import uuid4
-from time import sleep
+from contextlib import asynccontextmanager
 
-import aio_pika
+from aio_pika.exceptions import DeliveryError
+from aiormq import spec
 from functools import partial
 from aio_pika.channel import Channel
 from aio_pika.message import IncomingMessage, Message
 
+from . import metrics, tracing
+from .cache import CallCache
+from .codecs import DEFAULT_CONTENT_TYPE, get_codec
+from .compression import compress, decompress, get_compressor
+from .consumer import BatchConsumer, QueueConsumer
+from .outbox import Outbox
+from .pool import ChannelPool, connect_with_retry
+from .retry import Retrier, RetryPolicy
+from .sharding import ShardGroup, shard_for, shard_name
+
 # Параметры RMQ иначе используются дефолтные значения от контейнера.
 RMQ_LOGIN = os.environ.get("RMQ_LOGIN", "user")
 RMQ_PASSWORD = os.environ.get("RMQ_PASSWORD", "bitnami")
 RMQ_HOST = os.environ.get("RMQ_HOST", "127.0.0.1")
 RMQ_PORT = os.environ.get("RMQ_PORT", "5672")
 
+# amqp - RabbitMQ, memory - брокер в памяти процесса (для бенчмарков и локальной проверки).
+RMQ_BACKEND = os.environ.get("RMQ_BACKEND", "amqp")
+
+# Параметры пула: количество соединений и каналов для публикации.
+RMQ_CONNECTIONS = int(os.environ.get("RMQ_CONNECTIONS", "1"))
+RMQ_PUBLISHER_CHANNELS = int(os.environ.get("RMQ_PUBLISHER_CHANNELS", "4"))
+
 # Эти глобальные переменные хранят объекты соединения и канала к брокеру.
 # Функция connect_to_broker пытается в первую очередь использовать их, но если их нет, то она создаст их.
 BROKER_CONNECTION = None
 BROKER_CHANNEL = None
+BROKER_POOL = None
+
+
+class RPCTimeoutError(asyncio.TimeoutError):
+    """Ответ на RPC-вызов не был получен за отведенное время."""
+
+    def __init__(self, queue_name: str, correlation_id: str = None):
+        super().__init__(f"RPC call to {queue_name} timed out")
+        self.queue_name = queue_name
+        self.correlation_id = correlation_id
+
+
+class PublishError(Exception):
+    """Часть сообщений не была подтверждена брокером даже после повторных попыток."""
+
+    def __init__(self, queue_name: str, failed: list):
+        super().__init__(f"{len(failed)} message(s) to {queue_name} were not confirmed by broker")
+        self.queue_name = queue_name
+        self.failed = failed  # Индексы неподтвержденных сообщений.
+
+
+class RPCError(Exception):
+    """Обработчик RPC в другом сервисе завершился исключением."""
+
+    def __init__(self, queue_name: str, reason: str):
+        super().__init__(f"RPC call to {queue_name} failed: {reason}")
+        self.queue_name = queue_name
+        self.reason = reason
+
+
+class StreamError(Exception):
+    """Потоковый вызов завершился ошибкой обработчика или в потоке пропущена часть ответа."""
+
+    def __init__(self, queue_name: str, correlation_id: str, reason: str):
+        super().__init__(f"RPC stream from {queue_name} failed: {reason}")
+        self.queue_name = queue_name
+        self.correlation_id = correlation_id
+        self.reason = reason
 
 
 class BaseRMQ:
 
     channel = None
+    content_type = DEFAULT_CONTENT_TYPE  # Кодек для публикации по умолчанию.
+    compression = None  # Алгоритм сжатия (content_encoding), например "deflate". None - без сжатия.
+    compress_threshold = 1024  # Сжимаются только тела больше этого размера в байтах.
+    thread_pool_size = 32  # Размер пула потоков для синхронных обработчиков.
+    process_pool_size = None  # Размер пула процессов (None - по количеству ядер).
 
-    def __init__(self, channel: Channel = None):
+    def __init__(self, channel: Channel = None, pool: ChannelPool = None):
         self.channel = channel
+        self.pool = pool  # Если задан пул, то каналы для публикации и слушателей берутся из него.
+        self.consumers = []  # Запущенные слушатели очередей (QueueConsumer, BatchConsumer).
+        self.queue_content_types = {}  # Кодеки выбранные для отдельных очередей.
+        self.executors = {}  # Пулы "thread" и "process" созданные по требованию.
+
+    @asynccontextmanager
+    async def publisher_channel(self):
+        """Канал для публикации: из пула если он задан, иначе общий канал."""
+        if self.pool is None:
+            yield self.channel
+        else:
+            async with self.pool.acquire() as channel:
+                yield channel
+
+    async def publish(self, message: Message, routing_key: str, **kwargs):
+        """Публикация месседжа в дефолтный exchange."""
+        async with self.publisher_channel() as channel:
+            return await channel.default_exchange.publish(message, routing_key, **kwargs)
+
+    async def consumer_channel(self) -> Channel:
+        """Канал для слушателя: отдельный канал из пула если он задан, иначе общий канал."""
+        if self.pool is None:
+            return self.channel
+        return await self.pool.consumer_channel()
+
+    async def dedicated_channel(self) -> Channel:
+        """Новый канал который не делится ни с кем, даже без пула. Закрывается через release_channel."""
+        if self.pool is not None:
+            return await self.pool.consumer_channel()
+        # aio_pika.Channel не дает публичного доступа к своему соединению.
+        return await self.channel._connection.channel()
+
+    async def release_channel(self, channel: Channel):
+        """Закрытие канала полученного через consumer_channel или dedicated_channel, общий канал остается открытым."""
+        if channel is self.channel:
+            return
+        if self.pool is not None:
+            await self.pool.release_channel(channel)
+        elif not channel.is_closed:
+            await channel.close()
+
+    async def start_consumer(self, channel: Channel, queue, handler, consumer_class=QueueConsumer, **options):
+        """Запуск слушателя очереди, options передаются в consumer_class (concurrency/prefetch_count/...)."""
+        consumer = consumer_class(queue, handler, **options)
+        await consumer.start(channel)
+        self.consumers.append(consumer)
+        return consumer
+
+    async def close(self, timeout: float = None):
+        """Остановка всех слушателей с ожиданием обработки уже полученных месседжей."""
+        consumers, self.consumers = self.consumers, []
+        await asyncio.gather(*(consumer.close(timeout) for consumer in consumers))
+
+        executors, self.executors = self.executors, {}
+        for executor in executors.values():
+            executor.shutdown(wait=False)
+
+    def get_executor(self, executor=None) -> Executor:
+        """
+        Пул для выполнения обработчика вне event loop.
+
+        executor - "thread", "process" или готовый concurrent.futures.Executor.
+        Для "thread" и "process" пул создается один на экземпляр при первом обращении.
+        """
+        if isinstance(executor, Executor):
+            return executor
+
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown executor: {executor}")
+
+        if executor not in self.executors:
+            if executor == "thread":
+                self.executors[executor] = ThreadPoolExecutor(self.thread_pool_size, thread_name_prefix="rmq-handler")
+            else:
+                self.executors[executor] = ProcessPoolExecutor(self.process_pool_size)
+        return self.executors[executor]
 
     @staticmethod
-    def serialize(data: Any) -> bytes:
-        return json.dumps(data).encode()
+    def is_async_handler(func) -> bool:
+        return inspect.iscoroutinefunction(func) or inspect.iscoroutinefunction(getattr(func, "__call__", None))
+
+    def check_handler(self, func, executor=None):
+        """
+        Проверка обработчика при регистрации слушателя.
+
+        Иначе ошибка поднималась бы только при обработке и каждый месседж отклонялся бы без вызова обработчика.
+        """
+        if executor is None:
+            return
+        if self.is_async_handler(func) or inspect.isasyncgenfunction(func):
+            raise ValueError("Coroutine handlers can't be offloaded to an executor")
+        if not isinstance(executor, Executor) and executor not in ("thread", "process"):
+            raise ValueError(f"Unknown executor: {executor}")
+
+    async def run_handler(self, func, executor=None, args: tuple = (), kwargs: dict = None):
+        """
+        Вызов обработчика.
+
+        Корутины выполняются в event loop. Синхронные функции выполняются в пуле executor
+        (по умолчанию в пуле потоков), тем самым блокирующий обработчик не останавливает остальные
+        слушатели, ответы RPC и запросы FastAPI. Для CPU-bound обработчиков подходит executor="process",
+        в этом случае функция и аргументы должны сериализоваться через pickle.
+        """
+        if self.is_async_handler(func):
+            if executor is not None:
+                raise ValueError("Coroutine handlers can't be offloaded to an executor")
+            return await func(*args, **(kwargs or {}))
+
+        loop = asyncio.get_event_loop()
+        call = partial(func, *args, **(kwargs or {}))
+        result = await loop.run_in_executor(self.get_executor(executor or "thread"), call)
+
+        # Например lambda возвращающая корутину.
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    def set_queue_codec(self, queue_name: str, content_type: str):
+        """Выбор кодека для всех публикаций в очередь queue_name."""
+        get_codec(content_type)  # Проверка что кодек зарегистрирован.
+        self.queue_content_types[queue_name] = content_type
+
+    def content_type_for(self, queue_name: str, content_type: str = None) -> str:
+        """Кодек публикации: явно указанный, выбранный для очереди или кодек по умолчанию."""
+        return content_type or self.queue_content_types.get(queue_name) or self.content_type
+
+    def set_compression(self, encoding: str = "deflate", threshold: int = None):
+        """Включение сжатия тел месседжей больше threshold байт, encoding=None выключает сжатие."""
+        if encoding is not None:
+            get_compressor(encoding)  # Проверка что алгоритм зарегистрирован.
+        self.compression = encoding
+        if threshold is not None:
+            self.compress_threshold = threshold
+
+    def serialize(self, data: Any, content_type: str = None) -> bytes:
+        return get_codec(content_type or self.content_type).encode(data)
+
+    def deserialize(self, data: bytes, content_type: str = None) -> Any:
+        return get_codec(content_type).decode(data)
+
+    def encode_body(self, data: Any, content_type: str = None):
+        """Сериализация и сжатие тела, возвращает пару (body, content_encoding)."""
+        return compress(self.serialize(data, content_type), self.compression, self.compress_threshold)
 
     @staticmethod
-    def deserialize(data: bytes) -> Any:
-        return json.loads(data)
+    def decompress_message(message: IncomingMessage) -> IncomingMessage:
+        """Замена сжатого тела месседжа распакованным, чтобы обработчик мог читать message.body как есть."""
+        body = decompress(message.body, message.content_encoding)
+        if body is not message.body:
+            message.body = body
+            message.body_size = len(body)
+            message.content_encoding = None
+        return message
+
+    def decode_message(self, message: IncomingMessage) -> Any:
+        """Распаковка по content_encoding и десериализация тела месседжа согласно его content_type."""
+        body = decompress(message.body, message.content_encoding)
+        return self.deserialize(body, message.content_type)
 
 
 class MessageQueue(BaseRMQ):
     """Класс предазначен для работы по принципу publisher / subscriber."""
 
-    async def send(self, queue_name: str, data: Any):
-        """MQ-метод для отправки месседжа в один конец."""
-        # Крафт месседджа.
-        # Месседж - объект который получит другой сервис.
-        message = Message(
-            body=self.serialize(data),
-            content_type="application/json",
+    def make_message(self, data: Any, content_type: str = None) -> Message:
+        """Крафт месседжа - объекта который получит другой сервис."""
+        content_type = content_type or self.content_type
+        body, content_encoding = self.encode_body(data, content_type)
+        return Message(
+            body=body,
+            content_type=content_type,
+            content_encoding=content_encoding,
             correlation_id=str(uuid4()),
+            headers=tracing.inject({metrics.PUBLISHED_AT_HEADER: time.time()}),
         )
-        # Публикация сообщения в брокер используя дефолтную очередь.
-        await self.channel.default_exchange.publish(message, queue_name)
 
-    async def consume_queue(self, func, queue_name: str, auto_delete_queue: bool = False):
-        """Прослушивание очереди брокера."""
+    def __init__(self, channel: Channel = None, pool: ChannelPool = None):
+        super().__init__(channel, pool)
+        self.queue_shards = {}  # Количество шардов для очередей с partition_key.
+        self.outbox = None  # Если задан, send публикует через outbox.
+
+    def enable_outbox(self, **options) -> Outbox:
+        """
+        Публикация send через локальный outbox (параметры см. Outbox).
+
+        send возвращает управление сразу после постановки месседжа в outbox,
+        а месседжи публикуются пачками в фоне когда брокер доступен.
+        """
+        self.outbox = Outbox(self, **options)
+        self.outbox.start()
+        return self.outbox
+
+    async def close(self, timeout: float = None):
+        """Остановка слушателей и отправка оставшихся в outbox месседжей."""
+        await super().close(timeout)
+        if self.outbox is not None:
+            await self.outbox.close(timeout)
+            self.outbox = None
+
+    def set_queue_shards(self, queue_name: str, shards: int):
+        """Публикация в queue_name с partition_key распределяется по shards очередям {queue_name}.{номер}."""
+        if shards < 1:
+            raise ValueError("shards must be >= 1")
+        self.queue_shards[queue_name] = shards
+
+    def routing_key_for(self, queue_name: str, partition_key=None) -> str:
+        """Очередь для публикации: шард выбранный по partition_key или сама очередь."""
+        if partition_key is None:
+            return queue_name
+        if queue_name not in self.queue_shards:
+            raise ValueError(f"Queue {queue_name} is not sharded, call set_queue_shards first")
+        return shard_name(queue_name, shard_for(partition_key, self.queue_shards[queue_name]))
+
+    async def send(self, queue_name: str, data: Any, content_type: str = None, partition_key=None):
+        """
+        MQ-метод для отправки месседжа в один конец.
+
+        content_type выбирает кодек для этого месседжа, например "application/msgpack".
+        partition_key - ключ шардированной очереди (set_queue_shards), месседжи с одним ключом
+        попадают в один шард и обрабатываются по порядку.
+        """
+        routing_key = self.routing_key_for(queue_name, partition_key)
+        # Получатель запишет ожидание в очереди и обработку как дочерние спаны публикации.
+        with tracing.tracer.span("publish", queue=routing_key):
+            message = self.make_message(data, self.content_type_for(queue_name, content_type))
+            if self.outbox is not None:
+                await self.outbox.put(routing_key, message)
+                return
+
+            started = time.perf_counter()
+            # Публикация сообщения в брокер используя дефолтную очередь.
+            await self.publish(message, routing_key)
+            metrics.publish_seconds.observe(time.perf_counter() - started, routing_key)
+            metrics.published.inc(routing_key)
+
+    async def send_many(
+        self,
+        queue_name: str,
+        items,
+        window: int = 256,
+        retries: int = 3,
+        content_type: str = None,
+    ):
+        """
+        Пакетная отправка месседжей с подтверждением доставки.
+
+        Канал работает в режиме publisher confirms (по умолчанию в aio-pika), но вместо ожидания
+        подтверждения каждого месседжа по очереди в полете держится до window неподтвержденных публикаций.
+        Каждая публикация ждет свой ack/nack, месседжи получившие nack отправляются повторно до retries раз.
+        Если после всех попыток часть месседжей не подтверждена - поднимается PublishError.
+        """
+        content_type = self.content_type_for(queue_name, content_type)
+        messages = [self.make_message(data, content_type) for data in items]
+        failed = await self.publish_many(queue_name, messages, window, retries)
+        if failed:
+            raise PublishError(queue_name, failed)
+
+    async def publish_many(self, routing_key: str, messages: list, window: int = 256, retries: int = 3) -> list:
+        """Публикация готовых месседжей окном подтверждений (см. send_many), возвращает индексы неподтвержденных."""
+        semaphore = asyncio.Semaphore(window)
+
+        async def publish(exchange, message: Message) -> bool:
+            for attempt in range(retries + 1):
+                async with semaphore:
+                    try:
+                        await exchange.publish(message, routing_key)
+                        return True
+                    except DeliveryError as e:
+                        if not isinstance(e.frame, spec.Basic.Nack):
+                            raise
+                logging.debug(f"Message {message.correlation_id} was nacked by broker (attempt {attempt + 1})")
+            return False
+
+        # Весь пакет публикуется через один канал чтобы окно подтверждений работало на нем.
+        async with self.publisher_channel() as channel:
+            confirmed = await asyncio.gather(*(publish(channel.default_exchange, message) for message in messages))
+
+        failed = [index for index, ok in enumerate(confirmed) if not ok]
+        metrics.published.inc(routing_key, amount=len(messages) - len(failed))
+        return failed
+
+    async def consume_queue(
+        self,
+        func,
+        queue_name: str,
+        auto_delete_queue: bool = False,
+        concurrency: int = 1,
+        prefetch_count: int = None,
+        ordered_ack: bool = False,
+        executor=None,
+        retry: RetryPolicy = None,
+    ) -> QueueConsumer:
+        """
+        Прослушивание очереди брокера.
+
+        concurrency - сколько месседжей обрабатывается одновременно.
+        prefetch_count - сколько месседжей брокер отдает без подтверждения (по умолчанию равен concurrency).
+        ordered_ack - подтверждать месседжи строго в порядке получения.
+        executor - пул для синхронного обработчика: "thread" (по умолчанию), "process" или Executor.
+        retry - повтор упавших месседжей через очереди задержки, после всех попыток месседж уходит в {queue}.dlq.
+
+        Корутина получает IncomingMessage. Синхронная функция получает уже декодированное тело месседжа,
+        выполняется в пуле, а подтверждение месседжа остается в event loop.
+        """
+        self.check_handler(func, executor)
+        channel = await self.consumer_channel()
+
         # Создание queues в рабите
-        queue = await self.channel.declare_queue(queue_name, auto_delete=auto_delete_queue, durable=True)
+        queue = await channel.declare_queue(queue_name, auto_delete=auto_delete_queue, durable=True)
+
+        if executor is not None or not self.is_async_handler(func):
+            handler = partial(self.on_sync_message, func, executor)
+        else:
+            handler = partial(self.on_async_message, func)
+
+        return await self.start_consumer(
+            channel, queue, handler,
+            concurrency=concurrency,
+            prefetch_count=prefetch_count,
+            ordered_ack=ordered_ack,
+            retry=await self.declare_retry(channel, queue_name, retry),
+        )
+
+    async def declare_retry(self, channel: Channel, queue_name: str, policy: RetryPolicy = None) -> Retrier:
+        """Объявление очередей задержки для повторов, без policy повтор выключен."""
+        if policy is None:
+            return None
+        retrier = Retrier(self, queue_name, policy)
+        await retrier.declare(channel)
+        return retrier
+
+    async def consume_shards(
+        self,
+        func,
+        queue_name: str,
+        shards: int,
+        worker_index: int = None,
+        worker_count: int = None,
+        **options,
+    ) -> ShardGroup:
+        """
+        Прослушивание шардов очереди queue_name назначенных этому обработчику.
+
+        worker_index и worker_count по умолчанию берутся из WorkerRunner (rabbit.workers), вне его - 0 и 1.
+        Шард i слушает обработчик i % worker_count, каждый шард обрабатывается с concurrency=1 (если не задано иное),
+        поэтому месседжи одного ключа обрабатываются по порядку. options передаются в consume_queue.
+        При изменении количества обработчиков назначение меняется через ShardGroup.rebalance.
+        """
+        from . import workers
+
+        if worker_index is None:
+            worker_index = workers.WORKER_INDEX or 0
+        if worker_count is None:
+            worker_count = workers.WORKER_COUNT or 1
 
-        # Вроде как постоянное итерирование по очереди в ожидании месседжа.
-        # Есть алтернативный вариант получения месседжа через queue.get(timeout=N)
-        async with queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                logging.debug(f'Received message body: {message.body}')
-                await func(message)
+        self.queue_shards.setdefault(queue_name, shards)
+        group = ShardGroup(self, func, queue_name, shards, **options)
+        await group.start(worker_index, worker_count)
+        return group
+
+    async def on_async_message(self, func, message: IncomingMessage):
+        """Передача IncomingMessage с уже распакованным телом обработчику-корутине."""
+        await func(self.decompress_message(message))
+
+    async def on_sync_message(self, func, executor, message: IncomingMessage):
+        """Передача декодированного тела месседжа синхронному обработчику в пуле."""
+        await self.run_handler(func, executor, args=(self.decode_message(message),))
+
+    async def consume_batches(
+        self,
+        func,
+        queue_name: str,
+        batch_size: int = 100,
+        batch_timeout: float = 0.05,
+        prefetch_count: int = None,
+        requeue_failed: bool = True,
+        auto_delete_queue: bool = False,
+        executor=None,
+        retry: RetryPolicy = None,
+    ) -> BatchConsumer:
+        """
+        Прослушивание очереди с обработкой месседжей пачками (см. BatchConsumer).
+
+        batch_size - максимальный размер пачки, batch_timeout - сколько секунд ждать ее наполнения.
+        prefetch_count - по умолчанию две пачки, чтобы следующая собиралась во время обработки текущей.
+
+        Корутина получает список IncomingMessage. Синхронная функция получает список декодированных тел
+        и выполняется в пуле executor. Обработчик может вернуть индексы неудачных месседжей,
+        с retry они отправляются на повтор через очереди задержки вместо возврата в очередь.
+
+        Пачка подтверждается одним ack с multiple только на отдельном канале из пула,
+        без пула слушатель работает на общем канале и подтверждает месседжи по одному.
+        """
+        self.check_handler(func, executor)
+        channel = await self.consumer_channel()
+
+        queue = await channel.declare_queue(queue_name, auto_delete=auto_delete_queue, durable=True)
+
+        if executor is not None or not self.is_async_handler(func):
+            handler = partial(self.on_sync_batch, func, executor)
+        else:
+            handler = partial(self.on_async_batch, func)
+
+        return await self.start_consumer(
+            channel, queue, handler,
+            consumer_class=BatchConsumer,
+            batch_size=batch_size,
+            batch_timeout=batch_timeout,
+            prefetch_count=prefetch_count,
+            requeue_failed=requeue_failed,
+            multiple_ack=self.pool is not None,
+            retry=await self.declare_retry(channel, queue_name, retry),
+        )
+
+    async def on_async_batch(self, func, messages: list):
+        """Передача пачки IncomingMessage с уже распакованными телами обработчику-корутине."""
+        return await func([self.decompress_message(message) for message in messages])
+
+    async def on_sync_batch(self, func, executor, messages: list):
+        """Передача декодированных тел пачки синхронному обработчику в пуле."""
+        return await self.run_handler(func, executor, args=([self.decode_message(message) for message in messages],))
 
 
 class RPC(BaseRMQ):
@@ -74,6 +521,62 @@ class RPC(BaseRMQ):
 
     futures = {}
 
+    # Режимы получения ответов из другого сервиса.
+    REPLY_PER_CALL = "per_call"  # Новая очередь ответов на каждый вызов.
+    REPLY_SHARED = "shared"  # Одна долгоживущая очередь ответов на экземпляр RPC.
+    REPLY_DIRECT = "direct"  # Псевдо-очередь RabbitMQ amq.rabbitmq.reply-to.
+    REPLY_MODES = (REPLY_PER_CALL, REPLY_SHARED, REPLY_DIRECT)
+
+    DIRECT_REPLY_TO = "amq.rabbitmq.reply-to"
+
+    # Заголовки частей потокового ответа.
+    STREAM_SEQ_HEADER = "x-stream-seq"  # Номер части начиная с 0.
+    STREAM_END_HEADER = "x-stream-end"  # Признак завершающего месседжа без данных.
+    STREAM_ERROR_HEADER = "x-stream-error"  # Текст ошибки обработчика в завершающем месседже.
+    ERROR_HEADER = "x-rpc-error"  # Текст исключения обработчика в ответе.
+
+    def __init__(
+        self,
+        channel: Channel = None,
+        reply_mode: str = REPLY_SHARED,
+        timeout: float = None,
+        pool: ChannelPool = None,
+    ):
+        super().__init__(channel, pool)
+        if reply_mode not in self.REPLY_MODES:
+            raise ValueError(f"Unknown reply mode: {reply_mode}")
+        self.reply_mode = reply_mode
+        self.timeout = timeout  # Время ожидания ответа на call по умолчанию (None - без ограничения).
+        self.callback_queue = None
+        self._reply_channel = None
+        self._reply_source = None  # Пул или канал на котором была объявлена очередь ответов.
+        self.caches = {}  # Кэши результатов по названию очереди (CallCache).
+        self._reply_lock = None
+
+    def set_queue_codec(self, queue_name: str, content_type: str):
+        """Выбор кодека для вызовов queue_name, кодек должен передавать словарь именованных аргументов."""
+        if not get_codec(content_type).structured:
+            raise ValueError(f"Codec {content_type} can't encode RPC keyword arguments")
+        super().set_queue_codec(queue_name, content_type)
+
+    @staticmethod
+    def handler_arguments(payload) -> tuple:
+        """
+        Аргументы обработчика (args, kwargs) из тела запроса.
+
+        Словарь передается именованными аргументами, любое другое тело (например запрос
+        опубликованный не через RPC) - одним позиционным аргументом.
+        """
+        if isinstance(payload, dict):
+            return (), payload
+        return (payload,), None
+
+    @staticmethod
+    def reply_content_type(message: IncomingMessage) -> str:
+        """Ответ кодируется тем же кодеком что и запрос, а ответ на запрос в сырых байтах - кодеком по умолчанию."""
+        content_type = message.content_type or DEFAULT_CONTENT_TYPE
+        return content_type if get_codec(content_type).structured else DEFAULT_CONTENT_TYPE
+
     @staticmethod
     async def cancel_consumer(queue, consumers):
         """
@@ -85,90 +588,535 @@ class RPC(BaseRMQ):
         for key, val in consumers.items():
             await queue.cancel(key)
 
-    def on_response(self, message: IncomingMessage):
+    async def on_response(self, message: IncomingMessage):
         """
         Функция которая обрабатывает приходящий ответ из другого сервиса
 
         Magic-method
         """
-        future = self.futures.pop(message.correlation_id)
-        future.set_result(message.body)
-        message.ack()
+        # Путь ответа от публикации обработчиком до получения вызывающим.
+        parent = tracing.extract(message.headers)
+        published_at = (message.headers or {}).get(metrics.PUBLISHED_AT_HEADER)
+        if parent is not None and published_at is not None:
+            tracing.tracer.record("rpc.reply.wait", parent, float(published_at))
+
+        # Ответ может прийти на уже отмененный вызов, такой ответ просто отбрасывается.
+        future = self.futures.pop(message.correlation_id, None)
+        if future is not None and not future.done():
+            future.set_result(message)
+            metrics.rpc_responses.inc("matched")
+        else:
+            metrics.rpc_responses.inc("late")
+
+        # Сообщения из amq.rabbitmq.reply-to приходят в режиме no_ack.
+        if self.reply_mode != self.REPLY_DIRECT:
+            await message.ack()
+
+    async def setup_reply_queue(self):
+        """
+        Подготовка долгоживущей очереди ответов.
+
+        Вызывается автоматически при первом call, но можно вызвать и на старте приложения
+        чтобы не тратить время на объявление очереди во время первого запроса.
+        В режиме per_call ничего не делает.
+        """
+        if self.reply_mode == self.REPLY_PER_CALL:
+            return None
+
+        if self._reply_lock is None:
+            self._reply_lock = asyncio.Lock()
+
+        async with self._reply_lock:
+            # Если канал или пул были заменены, очередь ответов нужно объявить заново.
+            source = self.pool if self.pool is not None else self.channel
+            if self.callback_queue is not None and self._reply_source is source:
+                return self.callback_queue
+
+            channel = await self.consumer_channel()
+            if self.reply_mode == self.REPLY_DIRECT:
+                # Ответ в amq.rabbitmq.reply-to можно получить только на том же канале
+                # через который был опубликован запрос.
+                queue = await channel.declare_queue(self.DIRECT_REPLY_TO, passive=True)
+                await queue.consume(self.on_response, no_ack=True)
+            else:
+                queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+                await queue.consume(self.on_response)
+
+            self.callback_queue = queue
+            self._reply_channel = channel
+            self._reply_source = source
+
+        return self.callback_queue
+
+    def make_request(self, queue_name: str, payload: dict, correlation_id: str, reply_to: str) -> Message:
+        content_type = self.content_type_for(queue_name)
+        body, content_encoding = self.encode_body(payload, content_type)
+        return Message(
+            body=body,
+            content_type=content_type,
+            content_encoding=content_encoding,
+            correlation_id=correlation_id,
+            reply_to=reply_to,
+            headers=tracing.inject({metrics.PUBLISHED_AT_HEADER: time.time()}),
+        )
+
+    async def publish_request(self, queue_name: str, payload: dict, reply_to: str, channel: Channel = None):
+        """Публикация запроса и регистрация future по которому будет получен ответ."""
+        correlation_id = str(uuid4())
+
+        # Magic #1
+        future = asyncio.get_event_loop().create_future()
+
+        # Future регистрируется до публикации т.к ответ может прийти раньше подтверждения публикации.
+        self.futures[correlation_id] = future
+
+        message = self.make_request(queue_name, payload, correlation_id, reply_to)
+
+        # В режиме direct запрос публикуется на канале очереди ответов.
+        if channel is None and self.reply_mode == self.REPLY_DIRECT:
+            channel = self._reply_channel
+
+        try:
+            with tracing.tracer.span("rpc.publish", root=False, queue=queue_name):
+                if channel is not None:
+                    await channel.default_exchange.publish(message, routing_key=queue_name, mandatory=True)
+                else:
+                    await self.publish(message, routing_key=queue_name, mandatory=True)
+        except BaseException:
+            self.discard_future(correlation_id)
+            raise
+        return correlation_id, future
+
+    def discard_future(self, correlation_id: str):
+        """Удаление ожидающего future чтобы словарь futures не рос от вызовов без ответа."""
+        future = self.futures.pop(correlation_id, None)
+        if future is not None and not future.done():
+            future.cancel()
+
+    async def wait_response(
+        self, queue_name: str, correlation_id: str, future, timeout: float = None,
+    ) -> IncomingMessage:
+        """Ожидание ответа с таймаутом, по истечении которого future удаляется."""
+        try:
+            # shield нужен чтобы по таймауту future отменялся только через discard_future.
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            raise RPCTimeoutError(queue_name, correlation_id) from None
+        finally:
+            self.discard_future(correlation_id)
+
+    def decode_reply(self, queue_name: str, message: IncomingMessage) -> Any:
+        """Тело ответа, исключение обработчика в другом сервисе поднимается как RPCError."""
+        error = (message.headers or {}).get(self.ERROR_HEADER)
+        if error is not None:
+            raise RPCError(queue_name, error.decode() if isinstance(error, bytes) else error)
+        return self.decode_message(message)
+
+    def enable_cache(self, queue_name: str, ttl: float, maxsize: int = 1024) -> CallCache:
+        """
+        Включение кэша результатов call для очереди queue_name.
+
+        Ключ кэша - название очереди и аргументы вызова. Одновременные одинаковые вызовы
+        объединяются в один запрос к брокеру.
+        """
+        self.caches[queue_name] = CallCache(ttl, maxsize)
+        return self.caches[queue_name]
+
+    def disable_cache(self, queue_name: str):
+        self.caches.pop(queue_name, None)
+
+    def cache_stats(self) -> dict:
+        """Счетчики попаданий/промахов/объединенных вызовов по очередям."""
+        return {queue_name: cache.stats() for queue_name, cache in self.caches.items()}
 
     async def call(self, queue_name: str, **kwargs):
         """
         RPC-метод для отправки в другой сервис с целью возврата ответа из другого сервиса.
 
-        Данный метод на каждый вызов создает уникальную очередь
-        тем самым не скапливая в одной очереди множество запросов.
+        Если для очереди включен кэш (enable_cache), результат берется из него.
+        """
+        cache = self.caches.get(queue_name)
+        if cache is None:
+            return await self.call_uncached(queue_name, **kwargs)
+
+        key = cache.make_key(queue_name, kwargs)
+        return await cache.get_or_call(key, partial(self.call_uncached, queue_name, **kwargs))
 
-        Важно!!! Узнать в лучший способ использования создания анонимных очередей.
+    async def call_uncached(self, queue_name: str, **kwargs):
         """
+        Вызов в обход кэша.
+
+        В режимах shared и direct все ответы приходят в одну очередь экземпляра
+        и распределяются по futures через correlation_id.
+        В режиме per_call на каждый вызов создается уникальная очередь.
+
+        Если ответ не пришел за self.timeout секунд - поднимается RPCTimeoutError.
+        """
+        started = time.perf_counter()
+        status = "error"
+        with tracing.tracer.span("rpc.call", queue=queue_name) as span:
+            try:
+                result = await self.call_reply_queue(queue_name, **kwargs)
+                status = "ok"
+                return result
+            except RPCTimeoutError:
+                status = "timeout"
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                metrics.rpc_call_seconds.observe(elapsed, queue_name)
+                metrics.rpc_calls.inc(queue_name, status)
+                tracing.tracer.check_slow("RPC call to", queue_name, elapsed, span)
+
+    async def call_reply_queue(self, queue_name: str, **kwargs):
+        """Вызов с ожиданием ответа в очереди ответов согласно reply_mode."""
+        if self.reply_mode == self.REPLY_PER_CALL:
+            return await self.call_per_queue(queue_name, **kwargs)
+
+        callback_queue = await self.setup_reply_queue()
+
+        correlation_id, future = await self.publish_request(queue_name, kwargs, callback_queue.name)
+
+        # Magic #2 Выполняется только после того как другой сервис пришлет запрос.
+        response = await self.wait_response(queue_name, correlation_id, future, self.timeout)
+
+        return self.decode_reply(queue_name, response)
+
+    async def declare_call_queue(self, channel: Channel):
+        """Создание временной очереди ответов для режима per_call."""
         # Создание уникальной очереди на которую будет возвращен ответ из другого сервиса.
-        callback_queue = await self.channel.declare_queue(exclusive=True, auto_delete=True, durable=True)
+        callback_queue = await channel.declare_queue(exclusive=True, auto_delete=True, durable=True)
 
         await callback_queue.consume(self.on_response)  # Метод класса который обрабатывает ответ
 
         consumers = copy.copy(callback_queue._consumers)  # Копирование консумеров для удаления очереди из раббита
+        return callback_queue, consumers
+
+    async def call_per_queue(self, queue_name: str, **kwargs):
+        """
+        Вызов с созданием уникальной очереди ответов.
+
+        Каждый вызов объявляет очередь, подписывается на нее и отписывается после ответа,
+        что стоит нескольких обращений к брокеру на запрос.
+        """
+        async with self.publisher_channel() as channel:
+            callback_queue, consumers = await self.declare_call_queue(channel)
+
+        try:
+            correlation_id, future = await self.publish_request(queue_name, kwargs, callback_queue.name)
+
+            # Magic #2 Выполняется только после того как другой сервис пришлет запрос.
+            response = await self.wait_response(queue_name, correlation_id, future, self.timeout)
+        finally:
+            # Magic #3 Удаление слушателей.
+            # Почему-то даже с auto_delete очередь после выполнения не удаляется ссылаясь на консумера.
+            # Поэтому решение было вручную удалять консумера после выполнения задачи.
+            await self.cancel_consumer(callback_queue, consumers)
+
+        return self.decode_reply(queue_name, response)
+
+    async def iter_many(self, calls, timeout: float = None, deadline: float = None):
+        """
+        Конвейерная отправка нескольких запросов и получение ответов по мере их прихода.
 
+        calls - список пар (queue_name, kwargs), очереди могут быть разными.
+        timeout - время ожидания каждого ответа (по умолчанию self.timeout), отсчитывается от момента публикации запроса.
+        deadline - общее время на весь набор вызовов.
+
+        Генерирует пары (index, result) в порядке прихода ответов,
+        для неполученных ответов result - экземпляр RPCTimeoutError.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        calls = [(queue_name, dict(kwargs or {})) for queue_name, kwargs in calls]
+
+        callback_queue, consumers = None, None
+        if self.reply_mode == self.REPLY_PER_CALL:
+            # В режиме per_call на весь набор вызовов создается одна временная очередь.
+            async with self.publisher_channel() as channel:
+                callback_queue, consumers = await self.declare_call_queue(channel)
+        else:
+            callback_queue = await self.setup_reply_queue()
+
+        pending = {}  # future -> (index, queue_name, correlation_id, expires_at)
+        arrived = {}  # future -> время получения ответа, по нему ответ сверяется со сроком ожидания.
+        try:
+            # Все запросы публикуются одновременно, не дожидаясь подтверждения каждого по очереди.
+            published = await asyncio.gather(*(
+                self.publish_request(queue_name, kwargs, callback_queue.name) for queue_name, kwargs in calls
+            ), return_exceptions=True)
+
+            now = loop.time()
+            for index, ((queue_name, _), result) in enumerate(zip(calls, published)):
+                if isinstance(result, BaseException):
+                    yield index, result
+                    continue
+                correlation_id, future = result
+                expires_at = min(
+                    now + timeout if timeout is not None else float("inf"),
+                    started + deadline if deadline is not None else float("inf"),
+                )
+                pending[future] = (index, queue_name, correlation_id, expires_at)
+                future.add_done_callback(lambda item: arrived.setdefault(item, loop.time()))
+
+            while pending:
+                nearest = min(item[3] for item in pending.values())
+                wait_for = None if nearest == float("inf") else max(0.0, nearest - loop.time())
+                done, _ = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+
+                for future in done:
+                    index, queue_name, correlation_id, expires_at = pending.pop(future)
+                    if future.cancelled() or arrived.get(future, expires_at) > expires_at:
+                        # Ответ пришел позже срока, хотя event loop разбудил нас уже после этого.
+                        self.discard_future(correlation_id)
+                        metrics.rpc_calls.inc(queue_name, "timeout")
+                        yield index, RPCTimeoutError(queue_name, correlation_id)
+                        continue
+                    try:
+                        result = self.decode_reply(queue_name, future.result())
+                        metrics.rpc_calls.inc(queue_name, "ok")
+                    except RPCError as e:
+                        result = e
+                        metrics.rpc_calls.inc(queue_name, "error")
+                    yield index, result
+
+                now = loop.time()
+                for future, (index, queue_name, correlation_id, expires_at) in list(pending.items()):
+                    if expires_at <= now:
+                        del pending[future]
+                        self.discard_future(correlation_id)
+                        metrics.rpc_calls.inc(queue_name, "timeout")
+                        yield index, RPCTimeoutError(queue_name, correlation_id)
+        finally:
+            # Вызовы брошенные до получения ответа не должны оставаться в futures.
+            for index, queue_name, correlation_id, _ in pending.values():
+                self.discard_future(correlation_id)
+            if consumers is not None:
+                await self.cancel_consumer(callback_queue, consumers)
+
+    async def call_many(self, calls, timeout: float = None, deadline: float = None, return_partial: bool = False):
+        """
+        Scatter-gather: отправка нескольких запросов и сбор ответов в порядке calls.
+
+        Если return_partial=False и хотя бы один ответ не получен - поднимается ошибка,
+        иначе на месте неполученных ответов возвращаются экземпляры RPCTimeoutError,
+        а на месте ответов с ошибкой обработчика - экземпляры RPCError.
+
+        Пример:
+            users, posts = await rpc.call_many([("users_queue", {}), ("posts_queue", {"limit": 10})], timeout=5)
+        """
+        calls = list(calls)
+        results = [None] * len(calls)
+
+        replies = self.iter_many(calls, timeout=timeout, deadline=deadline)
+        try:
+            async for index, result in replies:
+                if isinstance(result, BaseException) and not return_partial:
+                    raise result
+                results[index] = result
+        finally:
+            # Закрытие генератора сразу подчищает futures оставшихся вызовов.
+            await replies.aclose()
+
+        return results
+
+    async def stream(self, queue_name: str, prefetch_count: int = 16, timeout: float = None, **kwargs):
+        """
+        Потоковый вызов: асинхронный итератор по частям ответа обработчика-генератора.
+
+        Части приходят в отдельную очередь вызова и отдаются по мере прихода. Месседж подтверждается
+        только когда читатель забирает часть, поэтому брокер держит у вызывающего не больше prefetch_count
+        частей, а остальные ждут в очереди брокера пока читатель не освободится.
+
+        timeout - сколько ждать очередную часть (по умолчанию self.timeout), иначе RPCTimeoutError.
+        Ошибка обработчика поднимается как StreamError. Если обработчик не генератор,
+        итератор отдает единственный обычный ответ.
+        """
+        timeout = self.timeout if timeout is None else timeout
         correlation_id = str(uuid4())
+        parts = asyncio.Queue()
+        status = "error"
 
-        # Magic #1
-        future = self.channel.loop.create_future()
+        # Все части одного потока должны прийти через одну очередь, тогда их порядок сохраняется.
+        # prefetch_count относится ко всему каналу, поэтому у потока свой канал, который закрывается вместе с ним.
+        channel = await self.dedicated_channel()
+        try:
+            await channel.set_qos(prefetch_count=prefetch_count)
+            queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+            consumer_tag = await queue.consume(parts.put)
+            try:
+                message = self.make_request(queue_name, kwargs, correlation_id, queue.name)
+                await channel.default_exchange.publish(message, routing_key=queue_name, mandatory=True)
 
-        self.futures[correlation_id] = future
+                expected = 0
+                while True:
+                    try:
+                        part = await asyncio.wait_for(parts.get(), timeout)
+                    except asyncio.TimeoutError:
+                        status = "timeout"
+                        raise RPCTimeoutError(queue_name, correlation_id) from None
+                    await part.ack()
 
-        await self.channel.default_exchange.publish(
-            Message(
-                body=self.serialize(kwargs),
-                content_type="application/json",
-                correlation_id=correlation_id,
-                reply_to=callback_queue.name,
-            ),
-            routing_key=queue_name,
-            mandatory=True
-        )
+                    headers = part.headers or {}
+                    if self.STREAM_SEQ_HEADER not in headers:
+                        # Обычный ответ от обработчика который не является генератором.
+                        result = self.decode_reply(queue_name, part)
+                        status = "ok"
+                        yield result
+                        return
 
-        # Magic #2 Выполняется только после того как другой сервис пришлет запрос.
-        response = await future
+                    seq = int(headers[self.STREAM_SEQ_HEADER])
+                    if seq < expected:
+                        continue  # Повторная доставка уже полученной части.
+                    if seq > expected:
+                        raise StreamError(queue_name, correlation_id, f"part {expected} is missing")
+                    expected += 1
 
-        # Magic #3 Удаление слушателей.
-        # Почему-то даже с auto_delete очередь после выполнения не удаляется ссылаясь на консумера.
-        # Поэтому решение было вручную удалять консумера после выполнения задачи.
-        await self.cancel_consumer(callback_queue, consumers)
+                    if headers.get(self.STREAM_END_HEADER):
+                        error = headers.get(self.STREAM_ERROR_HEADER)
+                        if error is not None:
+                            raise StreamError(
+                                queue_name, correlation_id, error.decode() if isinstance(error, bytes) else error,
+                            )
+                        status = "ok"
+                        return
 
-        return self.deserialize(response)
+                    yield self.decode_message(part)
+            finally:
+                metrics.rpc_calls.inc(queue_name, status)
+                await queue.cancel(consumer_tag)
+                await queue.delete(if_unused=False, if_empty=False)
+        finally:
+            await self.release_channel(channel)
 
-    async def consume_queue(self, func, queue_name: str):
-        """Прослушивание очереди брокера."""
-        queue = await self.channel.declare_queue(queue_name)
+    async def consume_queue(
+        self,
+        func,
+        queue_name: str,
+        concurrency: int = 1,
+        prefetch_count: int = None,
+        executor=None,
+    ) -> QueueConsumer:
+        """
+        Прослушивание очереди брокера.
+
+        concurrency - сколько вызовов обрабатывается одновременно.
+        prefetch_count - сколько запросов брокер отдает без подтверждения (по умолчанию равен concurrency).
+        executor - пул для синхронного обработчика: "thread" (по умолчанию), "process" или Executor.
+        Публикация ответа всегда выполняется в event loop.
+        """
+        self.check_handler(func, executor)
+        channel = await self.consumer_channel()
+        queue = await channel.declare_queue(queue_name)
 
         # Все очереди обрабатываются одной общей функцией.
         # В нее передается exchange, func и сам message.
 
         # Exchange используется для возврата ответа используя метод publish.
+        # При работе через пул exchange не передается и ответ публикуется через канал издателя.
+        exchange = channel.default_exchange if self.pool is None else None
 
         # partial работает как генерировании функции с аргументами,
         # Если пройтись по стеку тогда там на выходе будет что-то подобного on_call_message(message, exchange, func)
-        await queue.consume(partial(
-            self.on_call_message, self.channel.default_exchange, func)
+        return await self.start_consumer(
+            channel,
+            queue,
+            partial(self.on_call_message, exchange, func, executor=executor),
+            concurrency=concurrency,
+            prefetch_count=prefetch_count,
         )
 
-    async def on_call_message(self, exchange, func, message: IncomingMessage):
+    async def on_call_message(self, exchange, func, message: IncomingMessage, executor=None):
         """Единая функция для приема message из других сервисов и отправки обратно ответа."""
-        payload = self.deserialize(message.body)
+        payload = self.decode_message(message)
+        if inspect.isasyncgenfunction(func):
+            await self.on_stream_message(exchange, func, message, payload)
+            await message.ack()
+            return
+
+        headers = {}
         try:
-            result = await func(**payload)
+            args, kwargs = self.handler_arguments(payload)
+            result = await self.run_handler(func, executor, args, kwargs)
+            metrics.rpc_requests.inc(message.routing_key, "ok")
         except Exception as e:
-            result = self.serialize(dict(error='error', reason=str(e)))
+            logging.exception(f"RPC handler for {message.routing_key} failed")
+            # Ошибка передается заголовком, у вызывающего она поднимается как RPCError.
+            result = dict(error='error', reason=str(e))
+            headers[self.ERROR_HEADER] = str(e)
+            metrics.rpc_requests.inc(message.routing_key, "error")
 
-        result = self.serialize(result)
+        content_type = self.reply_content_type(message)
+        body, content_encoding = self.encode_body(result, content_type)
 
-        await exchange.publish(
-            Message(body=result, correlation_id=message.correlation_id),
-            routing_key=message.reply_to,
-        )
-        message.ack()
+        # Спан публикации ответа дочерний к спану обработки, его контекст уходит вызывающему в заголовках ответа.
+        with tracing.tracer.span("rpc.reply.publish", root=False, queue=message.routing_key):
+            headers[metrics.PUBLISHED_AT_HEADER] = time.time()
+            reply = Message(
+                body=body,
+                content_type=content_type,
+                content_encoding=content_encoding,
+                correlation_id=message.correlation_id,
+                headers=tracing.inject(headers),
+            )
+            if exchange is not None:
+                await exchange.publish(reply, routing_key=message.reply_to)
+            else:
+                await self.publish(reply, routing_key=message.reply_to)
+        await message.ack()
+
+    async def on_stream_message(self, exchange, func, message: IncomingMessage, payload):
+        """Отправка ответа обработчика-генератора частями."""
+        if exchange is not None:
+            await self.publish_stream(exchange, func, message, payload)
+            return
+
+        # Все части публикуются через один канал издателя чтобы брокер сохранил их порядок.
+        async with self.publisher_channel() as channel:
+            await self.publish_stream(channel.default_exchange, func, message, payload)
+
+    async def publish_stream(self, exchange, func, message: IncomingMessage, payload):
+        """
+        Каждое значение из генератора публикуется отдельным месседжем с тем же correlation_id
+        и номером части в заголовке, в конце публикуется завершающий месседж (в нем же передается ошибка).
+        """
+        content_type = self.reply_content_type(message)
+        seq = 0
+
+        async def send(body: bytes, content_encoding: str = None, **headers):
+            reply = Message(
+                body=body,
+                content_type=content_type,
+                content_encoding=content_encoding,
+                correlation_id=message.correlation_id,
+                headers={self.STREAM_SEQ_HEADER: seq, **headers},
+            )
+            await exchange.publish(reply, routing_key=message.reply_to)
+
+        end = {self.STREAM_END_HEADER: 1}
+        try:
+            args, kwargs = self.handler_arguments(payload)
+            async for item in func(*args, **(kwargs or {})):
+                await send(*self.encode_body(item, content_type))
+                seq += 1
+            metrics.rpc_requests.inc(message.routing_key, "ok")
+        except Exception as e:
+            logging.exception(f"Stream handler for {message.routing_key} failed")
+            end[self.STREAM_ERROR_HEADER] = str(e)
+            metrics.rpc_requests.inc(message.routing_key, "error")
+
+        await send(b"", **end)
+
+
+# Сколько RPC-вызовов ждут ответа, вычисляется при выдаче метрик.
+metrics.Gauge("rmq_rpc_pending_futures", "RPC calls waiting for a reply.", function=lambda: len(RPC.futures))
+
+
+def broker_url() -> str:
+    if RMQ_BACKEND == "memory":
+        return "memory://"
+    return f"amqp://{RMQ_LOGIN}:{RMQ_PASSWORD}@{RMQ_HOST}:{RMQ_PORT}/"
 
 
 async def connect_to_broker() -> Channel:
@@ -176,17 +1124,12 @@ async def connect_to_broker() -> Channel:
     global BROKER_CONNECTION
     global BROKER_CHANNEL
 
-    retries = 0
-    while not BROKER_CONNECTION:
-        conn_str = f"amqp://{RMQ_LOGIN}:{RMQ_PASSWORD}@{RMQ_HOST}:{RMQ_PORT}/"
+    if not BROKER_CONNECTION:
+        conn_str = broker_url()
         print(f"Trying to create connection to broker: {conn_str}")
-        try:
-            BROKER_CONNECTION = await aio_pika.connect_robust(conn_str)
-            print(f"Connected to broker ({type(BROKER_CONNECTION)} ID {id(BROKER_CONNECTION)})")
-        except Exception as e:
-            retries += 1
-            print(f"Can't connect to broker {retries} time({e.__class__.__name__}:{e}). Will retry in 5 seconds...")
-            sleep(5)
+        # Повторные попытки с jitter и без блокировки event loop.
+        BROKER_CONNECTION = await connect_with_retry(conn_str)
+        print(f"Connected to broker ({type(BROKER_CONNECTION)} ID {id(BROKER_CONNECTION)})")
 
     if not BROKER_CHANNEL:
         print("Trying to create channel to broker")
@@ -196,5 +1139,21 @@ async def connect_to_broker() -> Channel:
     return BROKER_CHANNEL
 
 
+def create_pool(connections: int = RMQ_CONNECTIONS, publisher_channels: int = RMQ_PUBLISHER_CHANNELS) -> ChannelPool:
+    """
+    Создание пула соединений и каналов к брокеру.
+
+    Подключение выполняется в фоне, поэтому функцию можно вызывать на старте приложения не блокируя его.
+    Методы mq и rpc дождутся готовности пула при первом обращении к брокеру.
+    """
+    global BROKER_POOL
+
+    if BROKER_POOL is None:
+        BROKER_POOL = ChannelPool(broker_url(), connections=connections, publisher_channels=publisher_channels)
+    BROKER_POOL.start()
+
+    return BROKER_POOL
+
+
 mq = MessageQueue()
 rpc = RPC()
@@ -0,0 +1,106 @@
+"""
+Шардирование очереди по ключу.
+
+Месседжи с одним ключом (partition_key) всегда попадают в одну и ту же очередь-шард {queue_name}.{номер},
+а каждый шард слушает ровно один обработчик. Тем самым порядок сохраняется внутри ключа,
+а разные ключи обрабатываются параллельно.
+"""
+import asyncio
+import hashlib
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping, Veach).
+
+    При изменении количества шардов с n на n + 1 в новый шард переезжает только 1/(n + 1) ключей.
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def key_hash(partition_key) -> int:
+    """Стабильный между процессами 64-битный хэш ключа (встроенный hash() для строк случаен в каждом процессе)."""
+    if isinstance(partition_key, bytes):
+        data = partition_key
+    else:
+        data = str(partition_key).encode()
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+def shard_for(partition_key, shards: int) -> int:
+    return jump_hash(key_hash(partition_key), shards)
+
+
+def shard_name(queue_name: str, shard: int) -> str:
+    return f"{queue_name}.{shard}"
+
+
+def assign_shards(shards: int, worker_index: int, worker_count: int) -> list:
+    """Шарды которые слушает обработчик worker_index из worker_count."""
+    if not 0 <= worker_index < worker_count:
+        raise ValueError(f"worker_index must be in range 0..{worker_count - 1}")
+    return list(range(worker_index, shards, worker_count))
+
+
+class ShardGroup:
+    """
+    Слушатели шардов одной очереди, назначенных обработчику worker_index из worker_count.
+
+    При start объявляются все шарды, даже не назначенные этому обработчику, чтобы месседжи
+    не терялись пока какой-то из обработчиков не запущен.
+    rebalance меняет назначение при изменении количества обработчиков: сначала слушатели снятых шардов
+    дообрабатывают полученные месседжи и отписываются, затем запускаются слушатели новых шардов.
+    Перестановку между процессами нужно делать так же - сначала остановить старые, потом запустить новые,
+    иначе на время перестановки шард могут слушать два обработчика и порядок внутри ключа нарушится.
+    """
+
+    def __init__(self, client, func, queue_name: str, shards: int, drain_timeout: float = 30, **options):
+        if shards < 1:
+            raise ValueError("shards must be >= 1")
+
+        self.client = client  # MessageQueue через который запускаются слушатели.
+        self.func = func
+        self.queue_name = queue_name
+        self.shards = shards
+        self.drain_timeout = drain_timeout
+        self.options = options  # Параметры consume_queue, для порядка внутри ключа concurrency должен быть 1.
+        self.consumers = {}  # номер шарда -> QueueConsumer
+        self.worker_index = None
+        self.worker_count = None
+
+    async def start(self, worker_index: int = 0, worker_count: int = 1):
+        async with self.client.publisher_channel() as channel:
+            for shard in range(self.shards):
+                await channel.declare_queue(shard_name(self.queue_name, shard), durable=True)
+        await self.rebalance(worker_index, worker_count)
+
+    async def rebalance(self, worker_index: int, worker_count: int):
+        assigned = set(assign_shards(self.shards, worker_index, worker_count))
+
+        removed = [self.consumers.pop(shard) for shard in sorted(set(self.consumers) - assigned)]
+        await self.stop(removed, self.drain_timeout)
+
+        for shard in sorted(assigned - set(self.consumers)):
+            self.consumers[shard] = await self.client.consume_queue(
+                self.func, shard_name(self.queue_name, shard), **self.options,
+            )
+
+        self.worker_index, self.worker_count = worker_index, worker_count
+
+    async def stop(self, consumers: list, timeout: float = None):
+        """Остановка слушателей и закрытие их каналов, у каждого шарда свой канал из пула."""
+        await asyncio.gather(*(consumer.close(timeout) for consumer in consumers))
+        for consumer in consumers:
+            if consumer in self.client.consumers:
+                self.client.consumers.remove(consumer)
+            if consumer.channel is not None:
+                await self.client.release_channel(consumer.channel)
+
+    async def close(self, timeout: float = None):
+        consumers, self.consumers = list(self.consumers.values()), {}
+        await self.stop(consumers, timeout)
@@ -0,0 +1,228 @@
+"""
+Трассировка публикаций, обработки и RPC-вызовов.
+
+Контекст трассы передается между сервисами заголовком traceparent в формате W3C Trace Context,
+время публикации - заголовком x-published-at (metrics.PUBLISHED_AT_HEADER). По ним получатель
+записывает спаны ожидания в очереди и обработки, а вызывающий - спан пути ответа.
+
+Трассы начинаются на стороне отправителя с вероятностью sample_rate, решение передается дальше в traceparent,
+поэтому без трассы обработка месседжа стоит только одной проверки заголовка.
+Спаны передаются в exporter. Если задан TRACE_FILE, они дописываются в него JSON-строками из фонового потока,
+иначе трассировка выключена пока exporter не подключен через configure.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+TRACEPARENT_HEADER = "traceparent"
+
+TRACE_FILE = os.environ.get("TRACE_FILE")
+# Доля трасс которые записываются (0 - трассировка выключена, 1 - все вызовы), без TRACE_FILE по умолчанию 0.
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01" if TRACE_FILE else "0"))
+# RPC-вызовы и обработчики дольше этого времени в секундах пишутся в лог (0 - выключено).
+TRACE_SLOW_SECONDS = float(os.environ.get("TRACE_SLOW_SECONDS", "1.0"))
+
+# Контекст родительского спана из заголовка traceparent.
+SpanContext = namedtuple("SpanContext", ["trace_id", "span_id"])
+
+# Текущий спан задачи, вложенные публикации и вызовы становятся его дочерними спанами.
+CURRENT_SPAN = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end", "status", "attributes")
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, start: float = None, attributes: dict = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = start if start is not None else time.time()
+        self.end = None
+        self.status = "ok"
+        self.attributes = attributes or {}
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def as_dict(self) -> dict:
+        return dict(
+            name=self.name,
+            trace_id=self.trace_id,
+            span_id=self.span_id,
+            parent_id=self.parent_id,
+            start=self.start,
+            end=self.end,
+            duration=self.duration,
+            status=self.status,
+            attributes=self.attributes,
+        )
+
+
+class Exporter:
+    """Получатель завершенных спанов."""
+
+    def export(self, span: Span):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class NullExporter(Exporter):
+    def export(self, span: Span):
+        pass
+
+
+class JSONLinesExporter(Exporter):
+    """
+    Запись спанов JSON-строками в файл.
+
+    export только кладет спан в очередь, а файл пишет фоновый поток, запущенный при первом спане,
+    поэтому медленный диск не блокирует event loop. Если очередь заполнена, спаны отбрасываются.
+    """
+
+    def __init__(self, path: str, maxsize: int = 10000):
+        self.path = path
+        self.spans = queue.Queue(maxsize)
+        self.dropped = 0
+        self._thread = None
+        self._pid = None
+
+    def export(self, span: Span):
+        # После fork поток родительского процесса в дочернем не работает, поэтому он запускается заново.
+        if self._thread is None or self._pid != os.getpid():
+            self.spans = queue.Queue(self.spans.maxsize)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.write, name="trace-exporter", daemon=True)
+            self._thread.start()
+        try:
+            self.spans.put_nowait(span.as_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def write(self):
+        with open(self.path, "a") as file:
+            while True:
+                item = self.spans.get()
+                if item is None:
+                    return
+                file.write(json.dumps(item) + "\n")
+                if self.spans.empty():
+                    file.flush()
+
+    def close(self):
+        if self._thread is not None and self._pid == os.getpid():
+            self.spans.put(None)
+            self._thread.join()
+        self._thread = None
+
+
+class Tracer:
+    def __init__(self, exporter: Exporter = None, sample_rate: float = 0.0, slow_seconds: float = 0.0):
+        self.exporter = exporter or NullExporter()
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+
+    def start_span(self, name: str, parent: SpanContext = None, start: float = None, root: bool = True, **attributes):
+        """
+        Новый спан или None если трасса не записывается.
+
+        Без parent спан становится дочерним к текущему спану задачи, а если его нет
+        и root=True - начинает новую трассу с вероятностью sample_rate.
+        """
+        if parent is None:
+            parent = CURRENT_SPAN.get()
+            if parent is None:
+                if not root or not self.sample_rate or random.random() >= self.sample_rate:
+                    return None
+                return Span(name, os.urandom(16).hex(), None, start, attributes)
+        return Span(name, parent.trace_id, parent.span_id, start, attributes)
+
+    def finish(self, span: Span, status: str = "ok", end: float = None):
+        if span is None:
+            return
+        span.end = end if end is not None else time.time()
+        span.status = status
+        try:
+            self.exporter.export(span)
+        except Exception:
+            logging.exception(f"Failed to export span {span.name}")
+
+    @contextmanager
+    def span(self, name: str, parent: SpanContext = None, root: bool = True, **attributes):
+        """Спан на время выполнения блока, внутри блока он становится текущим спаном задачи."""
+        span = self.start_span(name, parent, root=root, **attributes)
+        if span is None:
+            yield None
+            return
+
+        token = CURRENT_SPAN.set(span)
+        status = "ok"
+        try:
+            yield span
+        except BaseException as e:
+            status = f"error: {e.__class__.__name__}"
+            raise
+        finally:
+            CURRENT_SPAN.reset(token)
+            self.finish(span, status)
+
+    def record(self, name: str, parent: SpanContext, start: float, end: float = None, **attributes):
+        """Запись уже прошедшего этапа, например ожидания в очереди по времени публикации."""
+        self.finish(self.start_span(name, parent, start, root=False, **attributes), end=end)
+
+    def check_slow(self, kind: str, name: str, elapsed: float, span: Span = None):
+        """Запись в лог вызова или обработчика дольше slow_seconds."""
+        if self.slow_seconds and elapsed > self.slow_seconds:
+            trace = f" (trace {span.trace_id})" if span is not None else ""
+            logging.warning(f"Slow {kind} {name}: {elapsed:.3f}s{trace}")
+
+
+tracer = Tracer(JSONLinesExporter(TRACE_FILE) if TRACE_FILE else None, TRACE_SAMPLE_RATE, TRACE_SLOW_SECONDS)
+
+
+def configure(exporter: Exporter = None, sample_rate: float = None, slow_seconds: float = None):
+    """Замена exporter и параметров глобального tracer."""
+    if exporter is not None:
+        tracer.exporter.close()
+        tracer.exporter = exporter
+    if sample_rate is not None:
+        tracer.sample_rate = sample_rate
+    if slow_seconds is not None:
+        tracer.slow_seconds = slow_seconds
+
+
+def inject(headers: dict) -> dict:
+    """Добавление traceparent текущего спана в заголовки месседжа."""
+    span = CURRENT_SPAN.get()
+    if span is not None:
+        headers[TRACEPARENT_HEADER] = span.traceparent
+    return headers
+
+
+def extract(headers) -> SpanContext:
+    """Контекст родительского спана из заголовков, None если трасса не записывается."""
+    value = headers.get(TRACEPARENT_HEADER) if headers else None
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode()
+    parts = value.split("-")
+    try:
+        sampled = len(parts) == 4 and int(parts[3], 16) & 1
+    except ValueError:
+        return None
+    return SpanContext(parts[1], parts[2]) if sampled else None
@@ -1,37 +1,99 @@
+import asyncio
 import logging
+import os
 
-import requests
 import uvicorn
 from fastapi import FastAPI
-from rabbit.server import mq, rpc, connect_to_broker
+from fastapi.responses import Response
+from http_client import cached_get_json, close_client
+from rabbit import metrics
+from rabbit.retry import RetryPolicy
+from rabbit.server import mq, rpc, create_pool
+from rabbit.workers import WorkerRunner
+
+# all - HTTP API и слушатели в одном процессе, api - только HTTP API,
+# workers - только слушатели в CONSUMER_WORKERS процессах (по умолчанию по числу ядер).
+SERVICE_MODE = os.environ.get("SERVICE_MODE", "all")
+CONSUMER_WORKERS = int(os.environ.get("CONSUMER_WORKERS", "0")) or None
+# Количество шардов mq_sharded_queue, должно совпадать с сервисом A.
+MQ_SHARDS = int(os.environ.get("MQ_SHARDS", "8"))
 
 app = FastAPI()
 
+# Ответы со списком постов большие, поэтому сжимаются.
+rpc.set_compression("deflate", threshold=1024)
+
+
+# Фоновые задачи старта. Ссылка на задачу нужна чтобы ее не собрал сборщик мусора,
+# а ошибка в ней попала в лог, а не потерялась вместе с задачей.
+background_tasks = set()
+
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.get_event_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(on_background_task_done)
+    return task
+
+
+def on_background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("Background task failed", exc_info=task.exception())
+
+
+async def cancel_background_tasks():
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
 
 @app.on_event('startup')
 async def start_message_consuming():
-    channel = await connect_to_broker()
-    mq.channel = rpc.channel = channel
+    # Подключение к брокеру идет в фоне и не блокирует старт приложения.
+    mq.pool = rpc.pool = create_pool()
+
+    # В режиме api очереди слушают отдельно запущенные процессы-обработчики.
+    if SERVICE_MODE != "api":
+        run_in_background(register_consumers())
+
+
+async def register_consumers():
+    """Регистрация слушателей очередей, выполняется как только пул подключится к брокеру."""
+    await rpc.consume_queue(rpc_accept_message, "rpc_test_queue", concurrency=8)
+    await rpc.consume_queue(rpc_stream_posts, "rpc_stream_queue", concurrency=4)
+    # Упавшие месседжи повторяются через 1, 2, 4... секунды, после 5 попыток уходят в mq_test_queue.dlq.
+    await mq.consume_queue(mq_accept_message, "mq_test_queue", concurrency=16, retry=RetryPolicy(max_retries=5))
+    # В режиме workers каждый процесс слушает свою часть шардов.
+    await mq.consume_shards(mq_accept_message, "mq_sharded_queue", shards=MQ_SHARDS)
+
 
-    await rpc.consume_queue(rpc_accept_message, "rpc_test_queue")
-    await mq.consume_queue(mq_accept_message, "mq_test_queue")
+@app.on_event('shutdown')
+async def stop_message_consuming():
+    await cancel_background_tasks()
+    # Отписка от очередей и ожидание обработки уже полученных месседжей.
+    await mq.close(timeout=30)
+    await rpc.close(timeout=30)
+    await mq.pool.close()
+    await close_client()
 
 
-def get_fake_data() -> dict:
+async def get_fake_data() -> dict:
     """Открытый API-endpoint для получение рандомных данных."""
-    posts = requests.get("https://jsonplaceholder.typicode.com/posts")
-    return posts.json()
+    # Повторные запросы отдаются из кэша, устаревшие данные обновляются одним фоновым запросом.
+    return await cached_get_json("https://jsonplaceholder.typicode.com/posts")
 
 
 @app.get("/posts")
 async def get_posts() -> dict:
     """Публичный EndPoint для работы по REST"""
-    return get_fake_data()
+    return await get_fake_data()
 
 
 async def mq_accept_message(msg) -> None:
     """MQ-функция которая слушает очередь test-queue приходит объект IncomingMessage"""
-    print(get_fake_data())
+    print(await get_fake_data())
     # test = 1 / 0
     # Если не ack-ать message тогда она будет висеть в рабите
     # и при перезапуске приложения этот message снова попадет в функцию.
@@ -39,9 +101,26 @@ async def mq_accept_message(msg) -> None:
 
 
 async def rpc_accept_message(**kwargs):
-    print(**kwargs)
-    return get_fake_data()
+    print(kwargs)
+    return await get_fake_data()
+
+
+async def rpc_stream_posts(size: int = 20, **kwargs):
+    """Потоковый RPC: список постов отдается частями по size штук."""
+    posts = await get_fake_data()
+    for start in range(0, len(posts), size):
+        yield posts[start:start + size]
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики очередей и RPC в формате Prometheus."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 
 if __name__ == '__main__':
-    uvicorn.run("main:app", host="127.0.0.1", port=7041, reload=True, log_level="debug")
+    if SERVICE_MODE == "workers":
+        logging.basicConfig(level=logging.INFO)
+        WorkerRunner(register_consumers, (mq, rpc), workers=CONSUMER_WORKERS).run()
+    else:
+        uvicorn.run("main:app", host="127.0.0.1", port=7041, reload=True, log_level="debug")
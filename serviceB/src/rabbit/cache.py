@@ -0,0 +1,96 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any
+
+
+class TTLCache:
+    """LRU-кэш ограниченного размера, записи устаревают через ttl секунд."""
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        if maxsize < 1:
+            raise ValueError("maxsize must be >= 1")
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Возвращает пару (найдено, значение)."""
+        item = self._data.get(key)
+        if item is None:
+            return False, None
+
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return False, None
+
+        self._data.move_to_end(key)
+        return True, value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+class CallCache:
+    """
+    Кэш результатов RPC-вызовов одной очереди.
+
+    Одновременные одинаковые вызовы объединяются (single-flight): в брокер уходит один запрос,
+    а остальные вызовы ждут его результат. Ошибки не кэшируются.
+    Закэшированный результат возвращается как есть, изменять его нельзя.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.cache = TTLCache(ttl, maxsize)
+        self.inflight = {}  # key -> asyncio.Task
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(queue_name: str, kwargs: dict) -> str:
+        """Ключ из названия очереди и нормализованных аргументов (порядок ключей не важен)."""
+        return queue_name + ":" + json.dumps(kwargs, sort_keys=True, separators=(",", ":"), default=str)
+
+    async def get_or_call(self, key: str, call) -> Any:
+        found, value = self.cache.get(key)
+        if found:
+            self.hits += 1
+            return value
+
+        task = self.inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # Запрос выполняется отдельной задачей, поэтому отмена первого вызова не отменяет остальные.
+            task = asyncio.get_event_loop().create_task(call())
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self.on_done(key, done))
+
+        return await asyncio.shield(task)
+
+    def on_done(self, key: str, task: asyncio.Task):
+        self.inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.cache.set(key, task.result())
+
+    def stats(self) -> dict:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            coalesced=self.coalesced,
+            size=len(self.cache),
+            inflight=len(self.inflight),
+        )
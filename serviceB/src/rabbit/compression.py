@@ -0,0 +1,180 @@
+import gzip
+import time
+import zlib
+
+# Необязательные зависимости для более быстрых алгоритмов сжатия.
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+class Compressor:
+    """Алгоритм сжатия тела месседжа, encoding записывается в AMQP свойство content_encoding."""
+
+    encoding = None
+
+    def compress(self, body: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, body: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+    encoding = "deflate"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, body: bytes) -> bytes:
+        return zlib.compress(body, self.level)
+
+    def decompress(self, body: bytes) -> bytes:
+        return zlib.decompress(body)
+
+
+class GzipCompressor(Compressor):
+    encoding = "gzip"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, body: bytes) -> bytes:
+        return gzip.compress(body, self.level)
+
+    def decompress(self, body: bytes) -> bytes:
+        return gzip.decompress(body)
+
+
+class LZ4Compressor(Compressor):
+    encoding = "lz4"
+
+    def compress(self, body: bytes) -> bytes:
+        return lz4_frame.compress(body)
+
+    def decompress(self, body: bytes) -> bytes:
+        return lz4_frame.decompress(body)
+
+
+class ZstdCompressor(Compressor):
+    encoding = "zstd"
+
+    def __init__(self, level: int = 3):
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, body: bytes) -> bytes:
+        return self._compressor.compress(body)
+
+    def decompress(self, body: bytes) -> bytes:
+        return self._decompressor.decompress(body)
+
+
+class CompressionStats:
+    """Сколько байт сэкономлено сжатием и сколько времени CPU на это потрачено."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.compressed = 0  # Месседжей сжато.
+        self.skipped = 0  # Месседжей меньше порога или сжатие не дало выигрыша.
+        self.bytes_in = 0  # Размер сжатых месседжей до сжатия.
+        self.bytes_out = 0  # Размер сжатых месседжей после сжатия.
+        self.compress_seconds = 0.0
+        self.decompressed = 0
+        self.decompress_seconds = 0.0
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_in - self.bytes_out
+
+    def as_dict(self) -> dict:
+        return dict(
+            compressed=self.compressed,
+            skipped=self.skipped,
+            bytes_in=self.bytes_in,
+            bytes_out=self.bytes_out,
+            bytes_saved=self.bytes_saved,
+            ratio=self.bytes_out / self.bytes_in if self.bytes_in else 1.0,
+            compress_seconds=self.compress_seconds,
+            decompressed=self.decompressed,
+            decompress_seconds=self.decompress_seconds,
+        )
+
+
+# Реестр алгоритмов по content_encoding.
+COMPRESSORS = {}
+
+stats = CompressionStats()
+
+
+def register_compressor(compressor: Compressor):
+    """Регистрация алгоритма, уже зарегистрированный алгоритм для encoding будет заменен."""
+    COMPRESSORS[compressor.encoding] = compressor
+
+
+def get_compressor(encoding: str) -> Compressor:
+    try:
+        return COMPRESSORS[encoding]
+    except KeyError:
+        raise ValueError(f"No compressor registered for content encoding: {encoding}") from None
+
+
+def compress(body: bytes, encoding: str, threshold: int = 0):
+    """
+    Сжатие тела месседжа если оно больше threshold байт.
+
+    Возвращает пару (body, content_encoding), content_encoding равен None если сжатие не применялось.
+    """
+    if encoding is None:
+        # Сжатие выключено, месседж не учитывается в статистике.
+        return body, None
+    if len(body) < threshold:
+        stats.skipped += 1
+        return body, None
+
+    started = time.perf_counter()
+    compressed = get_compressor(encoding).compress(body)
+    stats.compress_seconds += time.perf_counter() - started
+
+    # Несжимаемые данные (например уже сжатые) отправляются как есть.
+    if len(compressed) >= len(body):
+        stats.skipped += 1
+        return body, None
+
+    stats.compressed += 1
+    stats.bytes_in += len(body)
+    stats.bytes_out += len(compressed)
+    return compressed, encoding
+
+
+def decompress(body: bytes, encoding: str = None) -> bytes:
+    """
+    Распаковка тела месседжа по content_encoding.
+
+    Неизвестные алгоритму значения content_encoding (например кодировка текста) не трогают тело.
+    """
+    compressor = COMPRESSORS.get(encoding) if encoding else None
+    if compressor is None:
+        return body
+
+    started = time.perf_counter()
+    body = compressor.decompress(body)
+    stats.decompress_seconds += time.perf_counter() - started
+    stats.decompressed += 1
+    return body
+
+
+register_compressor(ZlibCompressor())
+register_compressor(GzipCompressor())
+if lz4_frame is not None:
+    register_compressor(LZ4Compressor())
+if zstandard is not None:
+    register_compressor(ZstdCompressor())
@@ -0,0 +1,169 @@
+"""
+Метрики брокера в формате Prometheus.
+
+Реализация без внешних зависимостей и с минимальной стоимостью на горячем пути:
+значения хранятся в словарях по кортежу меток, гистограмма ищет бакет через bisect.
+"""
+import time
+from bisect import bisect_left
+
+# Бакеты задержек в секундах, от долей миллисекунды до десятков секунд.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Все созданные метрики в порядке создания.
+REGISTRY = []
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # кортеж значений меток -> значение
+        REGISTRY.append(self)
+
+    def header(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+    def render(self):
+        yield from self.header()
+        yield from self.samples()
+
+    def clear(self):
+        self.values.clear()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Значение устанавливается через set/inc/dec или вычисляется функцией function при выдаче метрик."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def samples(self):
+        if self.function is not None:
+            yield f"{self.name} {self.function()}"
+        else:
+            yield from super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        item = self.values.get(labels)
+        if item is None:
+            # [количество по бакетам (последний - +Inf), сумма, количество]
+            item = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        item[0][bisect_left(self.buckets, value)] += 1
+        item[1] += value
+        item[2] += 1
+
+    def time(self, *labels):
+        """Контекстный менеджер для замера времени выполнения блока."""
+        return Timer(self, labels)
+
+    def samples(self):
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="{}"'.format("+Inf" if bound == float("inf") else repr(bound))
+                yield f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {count}"
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Заголовок с временем публикации месседжа, по нему считается время ожидания в очереди.
+PUBLISHED_AT_HEADER = "x-published-at"
+
+published = Counter("rmq_published_total", "Messages published to the broker.", ["queue"])
+publish_seconds = Histogram("rmq_publish_seconds", "Time to publish a message including broker confirm.", ["queue"])
+consumed = Counter("rmq_consumed_total", "Messages processed by consumers.", ["queue", "status"])
+handler_seconds = Histogram("rmq_handler_seconds", "Consumer handler execution time.", ["queue"])
+queue_wait_seconds = Histogram("rmq_queue_wait_seconds", "Time between publish and the start of processing.", ["queue"])
+batch_size = Histogram(
+    "rmq_batch_size", "Messages per batch in batch consumers.", ["queue"],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+in_flight = Gauge("rmq_handlers_in_flight", "Messages currently being processed.", ["queue"])
+outbox_depth = Gauge("rmq_outbox_depth", "Messages waiting in the local outbox.", ["storage"])
+outbox_messages = Counter("rmq_outbox_messages_total", "Outbox events: queued, spilled, flushed, dropped, rejected.", ["status"])
+retries = Counter("rmq_retries_total", "Failed messages sent to a delay queue or dead-lettered.", ["queue", "status"])
+rpc_calls = Counter("rmq_rpc_calls_total", "RPC calls made by this process.", ["queue", "status"])
+rpc_call_seconds = Histogram("rmq_rpc_call_seconds", "RPC round trip time seen by the caller.", ["queue"])
+rpc_requests = Counter("rmq_rpc_requests_total", "RPC requests served by this process.", ["queue", "status"])
+rpc_responses = Counter("rmq_rpc_responses_total", "RPC replies received, late ones had no pending call.", ["status"])
+
+
+def queue_wait(headers, queue_name: str) -> float:
+    """Учет времени ожидания месседжа в очереди по заголовку PUBLISHED_AT_HEADER, возвращает время публикации."""
+    published_at = headers.get(PUBLISHED_AT_HEADER) if headers else None
+    if published_at is None:
+        return None
+    published_at = float(published_at)
+    queue_wait_seconds.observe(max(0.0, time.time() - published_at), queue_name)
+    return published_at
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.connection import wait
+
+from . import server
+from .pool import backoff_delays
+
+# Номер процесса-обработчика и их общее количество, заданы только внутри процесса запущенного WorkerRunner.
+WORKER_INDEX = None
+WORKER_COUNT = None
+
+
+async def serve_worker(register, clients, drain_timeout: float = 30):
+    """
+    Работа одного процесса-обработчика.
+
+    Процесс подключается к брокеру через connect_to_broker, все clients (mq, rpc) переводятся на это подключение
+    и вызывается register для регистрации слушателей. По SIGTERM/SIGINT слушатели отписываются от очередей,
+    дожидаются (не дольше drain_timeout секунд) и подтверждают уже полученные месседжи, затем соединение закрывается.
+    """
+    # Соединение родительского процесса (если оно было) не может использоваться после fork.
+    server.BROKER_CONNECTION = server.BROKER_CHANNEL = server.BROKER_POOL = None
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    channel = await server.connect_to_broker()
+    for client in clients:
+        client.channel = channel
+        client.pool = None
+
+    await register()
+    logging.info(f"Worker {WORKER_INDEX} (pid {os.getpid()}) is consuming")
+
+    await stopping.wait()
+    logging.info(f"Worker {WORKER_INDEX} (pid {os.getpid()}) is draining")
+    await asyncio.gather(*(client.close(timeout=drain_timeout) for client in clients))
+    await server.BROKER_CONNECTION.close()
+
+
+def worker_main(index: int, count: int, register, clients, drain_timeout: float):
+    global WORKER_INDEX, WORKER_COUNT
+
+    WORKER_INDEX, WORKER_COUNT = index, count
+    # После fork процесс наследует обработчики сигналов WorkerRunner, до установки своих сигнал должен завершать процесс.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    asyncio.run(serve_worker(register, clients, drain_timeout))
+
+
+class WorkerRunner:
+    """
+    Запуск слушателей очередей в нескольких процессах чтобы использовать все ядра.
+
+    Родительский процесс не подключается к брокеру, а только следит за процессами-обработчиками:
+    упавший процесс перезапускается с экспоненциальной задержкой (она сбрасывается если процесс
+    проработал дольше min_uptime секунд). По SIGTERM/SIGINT сигнал передается всем процессам
+    и родитель ждет их завершения, процессы не успевшие за drain_timeout + 5 секунд убиваются.
+    """
+
+    def __init__(
+        self,
+        register,
+        clients,
+        workers: int = None,
+        drain_timeout: float = 30,
+        min_uptime: float = 10,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+    ):
+        self.register = register
+        self.clients = tuple(clients)
+        self.workers = workers or os.cpu_count() or 1
+        self.drain_timeout = drain_timeout
+        self.min_uptime = min_uptime
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.context = multiprocessing.get_context("fork")
+        self.processes = [None] * self.workers
+        self.started_at = [0.0] * self.workers
+        self.delays = [backoff_delays(base_delay, max_delay) for _ in range(self.workers)]
+        self.restart_at = {}  # Номер процесса -> время когда его нужно перезапустить.
+        self.stopping = False
+
+    def spawn(self, index: int):
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, self.workers, self.register, self.clients, self.drain_timeout),
+            name=f"rmq-worker-{index}",
+        )
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        logging.info(f"Started worker {index} (pid {process.pid})")
+
+    def on_exit(self, index: int):
+        """Планирование перезапуска завершившегося процесса."""
+        process = self.processes[index]
+        self.processes[index] = None
+        if time.monotonic() - self.started_at[index] > self.min_uptime:
+            self.delays[index] = backoff_delays(self.base_delay, self.max_delay)
+        delay = next(self.delays[index])
+        self.restart_at[index] = time.monotonic() + delay
+        logging.warning(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, "
+                        f"restarting in {delay:.1f} seconds")
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(self.workers):
+            self.spawn(index)
+
+        while not self.stopping:
+            now = time.monotonic()
+            for index, restart_at in list(self.restart_at.items()):
+                if restart_at <= now:
+                    del self.restart_at[index]
+                    self.spawn(index)
+
+            running = {process.sentinel: index for index, process in enumerate(self.processes) if process}
+            for sentinel in wait(list(running), timeout=0.5):
+                self.processes[running[sentinel]].join()
+                self.on_exit(running[sentinel])
+
+        self.shutdown()
+
+    def shutdown(self):
+        """Передача SIGTERM процессам и ожидание пока они дообработают полученные месседжи."""
+        processes = [process for process in self.processes if process is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + self.drain_timeout + 5
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f"Worker pid {process.pid} did not stop in time, killing it")
+                process.kill()
+                process.join()
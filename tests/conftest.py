@@ -0,0 +1,53 @@
+"""
+Общие фикстуры тестов.
+
+Тесты используют код брокера из сервиса А (в сервисе Б он продублирован) и брокер в памяти процесса,
+поэтому RabbitMQ для них не нужен. Каждый тест получает свой MemoryBroker.
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "serviceA", "src")
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from rabbit import memory  # noqa: E402
+
+
+@pytest.fixture
+def broker() -> memory.MemoryBroker:
+    return memory.MemoryBroker()
+
+
+@pytest.fixture
+def run(broker):
+    """
+    Запуск сценария async def scenario(channel) в новом event loop.
+
+    Сценарий получает канал к брокеру теста, после сценария соединение закрывается.
+    """
+    def run(scenario):
+        async def main():
+            connection = await broker.connect()
+            channel = await connection.channel()
+            try:
+                return await scenario(channel)
+            finally:
+                await connection.close()
+
+        return asyncio.run(main())
+
+    return run
+
+
+async def wait_until(condition, timeout: float = 2.0):
+    """Ожидание пока condition() не станет истинным, брокер в памяти доставляет месседжи отдельными задачами."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError("Condition was not met in time")
+        await asyncio.sleep(0.005)
@@ -0,0 +1,118 @@
+from aio_pika.message import Message
+
+from conftest import wait_until
+from rabbit.consumer import BatchConsumer
+
+
+def record_settles(channel) -> list:
+    """Вызовы settle канала в виде (тело, multiple, requeue), requeue=None означает ack."""
+    calls = []
+    settle = channel.settle
+
+    def recording(message, multiple, requeue):
+        calls.append((message.body, multiple, requeue))
+        settle(message, multiple, requeue)
+
+    channel.settle = recording
+    return calls
+
+
+async def publish(channel, queue_name: str, count: int):
+    for index in range(count):
+        await channel.default_exchange.publish(Message(str(index).encode()), queue_name)
+
+
+def test_partial_failure_nacks_failed_and_acks_rest_with_one_frame(run, broker):
+    batches = []
+
+    async def handler(batch):
+        batches.append([message.body for message in batch])
+        return [1, 3]
+
+    async def scenario(channel):
+        calls = record_settles(channel)
+        queue = await channel.declare_queue("q")
+        await publish(channel, "q", 5)
+        consumer = BatchConsumer(queue, handler, batch_size=5, requeue_failed=False)
+        await consumer.start(channel)
+        await wait_until(lambda: len(calls) == 3)
+        await consumer.close()
+        return calls
+
+    calls = run(scenario)
+    assert batches == [[b"0", b"1", b"2", b"3", b"4"]]
+    assert calls == [(b"1", False, False), (b"3", False, False), (b"4", True, None)]
+    assert not broker.queues["q"].messages
+
+
+def test_failed_messages_are_requeued_and_redelivered(run):
+    batches = []
+
+    async def handler(batch):
+        batches.append([(message.body, message.redelivered) for message in batch])
+        return [0] if len(batches) == 1 else []
+
+    async def scenario(channel):
+        queue = await channel.declare_queue("q")
+        await publish(channel, "q", 3)
+        consumer = BatchConsumer(queue, handler, batch_size=3, batch_timeout=0.01)
+        await consumer.start(channel)
+        await wait_until(lambda: len(batches) == 2 and not channel.unacked)
+        await consumer.close()
+
+    run(scenario)
+    assert batches == [[(b"0", False), (b"1", False), (b"2", False)], [(b"0", True)]]
+
+
+def test_handler_exception_rejects_whole_batch(run, broker):
+    async def handler(batch):
+        raise ValueError("boom")
+
+    async def scenario(channel):
+        calls = record_settles(channel)
+        queue = await channel.declare_queue("q")
+        await publish(channel, "q", 3)
+        consumer = BatchConsumer(queue, handler, batch_size=3, requeue_failed=False)
+        await consumer.start(channel)
+        await wait_until(lambda: len(calls) == 3)
+        await consumer.close()
+        return calls
+
+    calls = run(scenario)
+    assert calls == [(b"0", False, False), (b"1", False, False), (b"2", False, False)]
+    assert not broker.queues["q"].messages
+
+
+def test_individual_acks_without_multiple_ack(run):
+    async def handler(batch):
+        return [1]
+
+    async def scenario(channel):
+        calls = record_settles(channel)
+        queue = await channel.declare_queue("q")
+        await publish(channel, "q", 3)
+        consumer = BatchConsumer(queue, handler, batch_size=3, requeue_failed=False, multiple_ack=False)
+        await consumer.start(channel)
+        await wait_until(lambda: len(calls) == 3)
+        await consumer.close()
+        return calls
+
+    assert run(scenario) == [(b"1", False, False), (b"0", False, None), (b"2", False, None)]
+
+
+def test_batch_is_flushed_by_timeout(run):
+    batches = []
+
+    async def handler(batch):
+        batches.append(len(batch))
+
+    async def scenario(channel):
+        queue = await channel.declare_queue("q")
+        await publish(channel, "q", 2)
+        consumer = BatchConsumer(queue, handler, batch_size=100, batch_timeout=0.01)
+        await consumer.start(channel)
+        await wait_until(lambda: batches and not channel.unacked)
+        await consumer.close()
+
+    run(scenario)
+    assert batches == [2]
@@ -0,0 +1,56 @@
+import json
+
+from conftest import wait_until
+from rabbit import compression
+from rabbit.server import MessageQueue
+
+PAYLOAD = {"text": "hello world " * 20}
+
+
+def test_compress_skips_stats_when_disabled():
+    compression.stats.reset()
+    assert compression.compress(b"x" * 100, None) == (b"x" * 100, None)
+    assert compression.stats.skipped == 0
+
+
+def test_coroutine_handler_receives_decompressed_body(run, broker):
+    received = []
+
+    async def handler(message):
+        received.append((message.content_encoding, json.loads(message.body)))
+        await message.ack()
+
+    async def scenario(channel):
+        mq = MessageQueue(channel)
+        mq.set_compression("deflate", threshold=10)
+        await mq.consume_queue(handler, "q")
+        await mq.send("q", PAYLOAD)
+        await wait_until(lambda: received)
+        await mq.close()
+
+    run(scenario)
+    assert received == [(None, PAYLOAD)]
+
+
+def test_batch_and_sync_handlers_receive_decompressed_payload(run):
+    batches, payloads = [], []
+
+    async def batch_handler(batch):
+        batches.append([json.loads(message.body) for message in batch])
+
+    def sync_handler(payload):
+        payloads.append(payload)
+
+    async def scenario(channel):
+        mq = MessageQueue(channel)
+        mq.set_compression("deflate", threshold=10)
+        await mq.consume_batches(batch_handler, "batches", batch_timeout=0.01)
+        await mq.consume_queue(sync_handler, "sync")
+        await mq.send("batches", PAYLOAD)
+        await mq.send("sync", PAYLOAD)
+        await wait_until(lambda: batches and payloads)
+        await mq.close()
+
+    run(scenario)
+    assert batches == [[PAYLOAD]]
+    assert payloads == [PAYLOAD]
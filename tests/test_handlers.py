@@ -0,0 +1,46 @@
+import pytest
+
+from conftest import wait_until
+from rabbit.server import RPC, MessageQueue
+
+
+async def coroutine_handler(message):
+    await message.ack()
+
+
+async def stream_handler():
+    yield 1
+
+
+@pytest.mark.parametrize("register", [
+    lambda channel: MessageQueue(channel).consume_queue(coroutine_handler, "q", executor="thread"),
+    lambda channel: MessageQueue(channel).consume_batches(coroutine_handler, "q", executor="thread"),
+    lambda channel: RPC(channel).consume_queue(coroutine_handler, "q", executor="thread"),
+    lambda channel: RPC(channel).consume_queue(stream_handler, "q", executor="process"),
+    lambda channel: MessageQueue(channel).consume_queue(print, "q", executor="fork"),
+])
+def test_invalid_executor_is_rejected_at_registration(run, broker, register):
+    async def scenario(channel):
+        with pytest.raises(ValueError):
+            await register(channel)
+
+    run(scenario)
+    # Слушатель не запущен и очередь не объявлена, поэтому месседжи не будут отклоняться молча.
+    assert "q" not in broker.queues
+
+
+def test_sync_handler_runs_in_executor(run):
+    received = []
+
+    def handler(payload):
+        received.append(payload)
+
+    async def scenario(channel):
+        mq = MessageQueue(channel)
+        await mq.consume_queue(handler, "q", executor="thread")
+        await mq.send("q", {"value": 1})
+        await wait_until(lambda: received)
+        await mq.close()
+
+    run(scenario)
+    assert received == [{"value": 1}]
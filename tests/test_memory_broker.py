@@ -0,0 +1,49 @@
+from aio_pika.message import Message
+
+from conftest import wait_until
+
+
+def test_unacked_messages_return_to_queue_when_channel_closes(run, broker):
+    async def scenario(channel):
+        queue = await channel.declare_queue("q")
+        received = []
+        await queue.consume(received.append)
+        await channel.default_exchange.publish(Message(b"1"), "q")
+        await wait_until(lambda: received)
+        await channel.close()
+
+    run(scenario)
+    message, redelivered = broker.queues["q"].messages[0]
+    assert message.body == b"1"
+    assert redelivered
+
+
+def test_expired_message_is_dead_lettered_into_target_queue(run, broker):
+    async def scenario(channel):
+        await channel.declare_queue("target")
+        await channel.declare_queue(
+            "delay",
+            arguments={"x-message-ttl": 20, "x-dead-letter-exchange": "", "x-dead-letter-routing-key": "target"},
+        )
+        await channel.default_exchange.publish(Message(b"late"), "delay")
+        assert broker.queues["delay"].messages
+        await wait_until(lambda: broker.queues["target"].messages)
+
+    run(scenario)
+    assert not broker.queues["delay"].messages
+    assert [message.body for message, _ in broker.queues["target"].messages] == [b"late"]
+
+
+def test_multiple_ack_settles_all_earlier_deliveries(run):
+    async def scenario(channel):
+        queue = await channel.declare_queue("q")
+        received = []
+        await queue.consume(received.append)
+        for body in (b"1", b"2", b"3"):
+            await channel.default_exchange.publish(Message(body), "q")
+        await wait_until(lambda: len(received) == 3)
+
+        received[1].ack(multiple=True)
+        assert sorted(channel.unacked) == [received[2].delivery_tag]
+
+    run(scenario)
@@ -0,0 +1,191 @@
+import asyncio
+
+import pytest
+from aio_pika.message import DeliveryMode, Message
+
+from conftest import wait_until
+from rabbit.outbox import Outbox, OutboxFull, SpillLog
+from rabbit.server import MessageQueue
+
+
+class FlakyClient:
+    """Клиент outbox: первые failures вызовов publish_many не подтверждают месседжи, пока gate закрыт - ждут."""
+
+    pool = None
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.published = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def publish_many(self, routing_key: str, messages: list) -> list:
+        await self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            return list(range(len(messages)))
+        self.published.extend(message.body for message in messages)
+        return []
+
+
+def bodies(count: int) -> list:
+    return [str(index).encode() for index in range(count)]
+
+
+def make_outbox(client, **options) -> Outbox:
+    options.setdefault("base_delay", 0.001)
+    options.setdefault("max_delay", 0.001)
+    return Outbox(client, **options)
+
+
+def test_raise_policy_rejects_when_full():
+    async def scenario():
+        client = FlakyClient()
+        client.gate.clear()
+        outbox = make_outbox(client, maxsize=2, policy=Outbox.RAISE)
+        for body in bodies(2):
+            await outbox.put("q", Message(body))
+        with pytest.raises(OutboxFull):
+            await outbox.put("q", Message(b"extra"))
+
+        client.gate.set()
+        await outbox.close(timeout=1)
+        return client.published
+
+    assert asyncio.run(scenario()) == [b"0", b"1"]
+
+
+def test_drop_oldest_policy_keeps_newest():
+    async def scenario():
+        client = FlakyClient()
+        outbox = make_outbox(client, maxsize=2, policy=Outbox.DROP_OLDEST)
+        # Фоновая отправка еще не начиналась, поэтому все месседжи остаются в памяти.
+        for body in bodies(4):
+            await outbox.put("q", Message(body))
+        await outbox.close(timeout=1)
+        return client.published
+
+    assert asyncio.run(scenario()) == [b"2", b"3"]
+
+
+def test_block_policy_waits_for_free_space():
+    async def scenario():
+        client = FlakyClient()
+        client.gate.clear()
+        outbox = make_outbox(client, maxsize=2, batch_size=2)
+        for body in bodies(2):
+            await outbox.put("q", Message(body))
+
+        blocked = asyncio.get_event_loop().create_task(outbox.put("q", Message(b"2")))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+
+        client.gate.set()
+        await asyncio.wait_for(blocked, 1)
+        await outbox.close(timeout=1)
+        return client.published
+
+    assert asyncio.run(scenario()) == [b"0", b"1", b"2"]
+
+
+def test_failed_flush_is_retried_without_exceeding_maxsize():
+    async def scenario():
+        client = FlakyClient(failures=1)
+        client.gate.clear()
+        outbox = make_outbox(client, maxsize=2, batch_size=2, policy=Outbox.RAISE)
+        for body in bodies(2):
+            await outbox.put("q", Message(body))
+        await asyncio.sleep(0)  # Пачка взята в отправку и ждет брокер.
+
+        # Неподтвержденная пачка все еще занимает место, возврат в очередь не превышает maxsize.
+        with pytest.raises(OutboxFull):
+            await outbox.put("q", Message(b"extra"))
+        client.gate.set()
+        await wait_until(lambda: len(client.published) == 2)
+        assert outbox.depth == 0
+        await outbox.close(timeout=1)
+        return client.published
+
+    assert asyncio.run(scenario()) == [b"0", b"1"]
+
+
+def test_overflow_spills_to_disk_and_keeps_order(run, broker, tmp_path):
+    path = str(tmp_path / "outbox.log")
+
+    async def scenario(channel):
+        await channel.declare_queue("q")
+        outbox = make_outbox(MessageQueue(channel), maxsize=2, batch_size=2, spill_path=path)
+        for body in bodies(6):
+            await outbox.put("q", Message(body))
+        assert len(outbox.items) == 2
+        assert outbox.spill.pending == 4
+
+        await wait_until(lambda: outbox.depth == 0)
+        await outbox.close(timeout=1)
+
+    run(scenario)
+    assert [message.body for message, _ in broker.queues["q"].messages] == bodies(6)
+    assert (tmp_path / "outbox.log").stat().st_size == 0
+
+
+def test_spilled_messages_survive_failed_flush(tmp_path):
+    path = str(tmp_path / "outbox.log")
+
+    async def scenario():
+        client = FlakyClient(failures=3)
+        outbox = make_outbox(client, maxsize=1, batch_size=2, spill_path=path)
+        for body in bodies(5):
+            await outbox.put("q", Message(body))
+        await wait_until(lambda: outbox.depth == 0)
+        await outbox.close(timeout=1)
+        return client.published
+
+    assert asyncio.run(scenario()) == bodies(5)
+
+
+def test_spill_log_is_read_again_until_commit(tmp_path):
+    path = str(tmp_path / "outbox.log")
+    log = SpillLog(path)
+    for body in bodies(3):
+        log.append("q", Message(body))
+
+    first = log.read(2)
+    assert [message.body for _, message in log.read(2)] == [message.body for _, message in first] == bodies(2)
+    assert log.pending == 3
+
+    log.commit(1)
+    assert [message.body for _, message in log.read(5)] == [b"1", b"2"]
+    log.commit(2)
+    assert log.pending == 0
+    log.close()
+
+
+def test_spill_log_keeps_message_properties_after_restart(tmp_path):
+    path = str(tmp_path / "outbox.log")
+    log = SpillLog(path)
+    log.append("q", Message(
+        b"body",
+        content_type="application/json",
+        correlation_id="c1",
+        reply_to="replies",
+        message_id="m1",
+        priority=5,
+        delivery_mode=DeliveryMode.PERSISTENT,
+        headers={"x-key": "value"},
+    ))
+    log.close()
+
+    log = SpillLog(path)
+    assert log.pending == 1
+    [(routing_key, message)] = log.read(1)
+    log.close()
+
+    assert routing_key == "q"
+    assert message.body == b"body"
+    assert message.content_type == "application/json"
+    assert message.correlation_id == "c1"
+    assert message.reply_to == "replies"
+    assert message.message_id == "m1"
+    assert message.priority == 5
+    assert message.delivery_mode == DeliveryMode.PERSISTENT
+    assert message.headers == {"x-key": "value"}
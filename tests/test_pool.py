@@ -0,0 +1,41 @@
+import asyncio
+
+from rabbit import memory
+from rabbit.pool import ChannelPool
+
+
+def test_pool_retries_channel_setup_after_failure(monkeypatch):
+    failures = [RuntimeError("channel error")]
+    channel = memory.MemoryConnection.channel
+
+    async def flaky_channel(self, *args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return await channel(self, *args, **kwargs)
+
+    monkeypatch.setattr(memory.MemoryConnection, "channel", flaky_channel)
+
+    async def scenario():
+        pool = ChannelPool("memory://", publisher_channels=2, base_delay=0.001, max_delay=0.001)
+        await asyncio.wait_for(pool.wait_ready(), 1)
+        async with pool.acquire() as acquired:
+            assert not acquired.is_closed
+        publishers = len(pool.publishers)
+        await pool.close()
+        return publishers
+
+    assert asyncio.run(scenario()) == 2
+    assert not failures
+
+
+def test_consumer_channels_are_closed_with_pool():
+    async def scenario():
+        pool = ChannelPool("memory://")
+        first = await pool.consumer_channel()
+        second = await pool.consumer_channel()
+        await pool.release_channel(first)
+        assert first.is_closed and not second.is_closed
+        await pool.close()
+        return second.is_closed
+
+    assert asyncio.run(scenario())
@@ -0,0 +1,120 @@
+import pytest
+from aio_pika.message import DeliveryMode, Message
+
+from conftest import wait_until
+from rabbit.consumer import BatchConsumer
+from rabbit.retry import ATTEMPT_HEADER, ERROR_HEADER, Retrier, RetryPolicy, dead_letter_queue_name, delay_queue_name
+from rabbit.server import MessageQueue
+
+
+def test_policy_delays_grow_exponentially_up_to_max_delay():
+    policy = RetryPolicy(max_retries=5, base_delay=1.0, factor=2.0, max_delay=5.0)
+    assert [policy.delay_for(attempt) for attempt in range(5)] == [1.0, 2.0, 4.0, 5.0, 5.0]
+    assert policy.delays() == [1.0, 2.0, 4.0, 5.0]
+
+
+@pytest.mark.parametrize("options", [dict(max_retries=-1), dict(base_delay=0), dict(base_delay=-1.0)])
+def test_policy_rejects_invalid_options(options):
+    with pytest.raises(ValueError):
+        RetryPolicy(**options)
+
+
+def test_failed_message_is_retried_then_dead_lettered(run, broker):
+    policy = RetryPolicy(max_retries=2, base_delay=0.01, factor=2.0)
+    attempts = []
+
+    async def handler(message):
+        attempts.append(message.headers.get(ATTEMPT_HEADER))
+        raise ValueError("boom")
+
+    async def scenario(channel):
+        mq = MessageQueue(channel)
+        await mq.consume_queue(handler, "q", retry=policy)
+        await mq.publish(Message(
+            b"payload",
+            correlation_id="c1",
+            message_id="m1",
+            priority=3,
+            type="event",
+            delivery_mode=DeliveryMode.PERSISTENT,
+            headers={"x-key": "value"},
+        ), "q")
+
+        dlq = broker.queues[dead_letter_queue_name("q")]
+        await wait_until(lambda: dlq.messages)
+        await mq.close()
+        return dlq.messages[0][0]
+
+    dead = run(scenario)
+    # Первая доставка и два повтора: через 10 и 20 миллисекунд.
+    assert attempts == [None, 1, 2]
+    assert set(broker.queues) >= {delay_queue_name("q", 0.01), delay_queue_name("q", 0.02)}
+    assert not broker.queues["q"].messages
+    assert dead.body == b"payload"
+    assert dead.headers[ATTEMPT_HEADER] == 2
+    assert dead.headers[ERROR_HEADER] == "ValueError: boom"
+    assert dead.headers["x-key"] == "value"
+    assert (dead.correlation_id, dead.message_id, dead.priority, dead.type) == ("c1", "m1", 3, "event")
+    assert dead.delivery_mode == DeliveryMode.PERSISTENT
+
+
+def test_message_succeeds_after_retry(run, broker):
+    received = []
+
+    async def handler(message):
+        received.append(message.headers.get(ATTEMPT_HEADER))
+        if len(received) == 1:
+            raise ValueError("boom")
+        await message.ack()
+
+    async def scenario(channel):
+        mq = MessageQueue(channel)
+        await mq.consume_queue(handler, "q", retry=RetryPolicy(max_retries=3, base_delay=0.01))
+        await mq.send("q", {"value": 1})
+        await wait_until(lambda: len(received) == 2 and not channel.unacked)
+        await mq.close()
+
+    run(scenario)
+    assert received == [None, 1]
+    assert not broker.queues[dead_letter_queue_name("q")].messages
+
+
+def test_retrier_routes_message_to_delay_queue(run, broker):
+    async def scenario(channel):
+        mq = MessageQueue(channel)
+        retrier = Retrier(mq, "q", RetryPolicy(max_retries=2, base_delay=10.0))
+        await retrier.declare(channel)
+
+        queue = await channel.declare_queue("q")
+        received = []
+        await queue.consume(received.append)
+        await mq.publish(Message(b"x", headers={ATTEMPT_HEADER: 1}), "q")
+        await wait_until(lambda: received)
+        await retrier.handle(received[0], "error")
+
+    run(scenario)
+    [(message, _)] = broker.queues[delay_queue_name("q", 20.0)].messages
+    assert message.headers[ATTEMPT_HEADER] == 2
+    assert broker.queues[delay_queue_name("q", 20.0)].arguments["x-dead-letter-routing-key"] == "q"
+
+
+def test_batch_consumer_sends_failed_messages_to_retry(run, broker):
+    batches = []
+
+    async def handler(batch):
+        batches.append([message.body for message in batch])
+        return [0] if len(batches) == 1 else []
+
+    async def scenario(channel):
+        mq = MessageQueue(channel)
+        retrier = await mq.declare_retry(channel, "q", RetryPolicy(max_retries=1, base_delay=0.01))
+        queue = await channel.declare_queue("q")
+        for body in (b"a", b"b"):
+            await mq.publish(Message(body), "q")
+        consumer = BatchConsumer(queue, handler, batch_size=2, batch_timeout=0.01, retry=retrier)
+        await consumer.start(channel)
+        await wait_until(lambda: len(batches) == 2 and not channel.unacked)
+        await consumer.close()
+
+    run(scenario)
+    assert batches == [[b"a", b"b"], [b"a"]]
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+import pytest
+
+from conftest import wait_until
+from rabbit.server import RPC, RPCError, RPCTimeoutError
+
+
+async def echo(delay: float = 0, **kwargs):
+    await asyncio.sleep(delay)
+    return kwargs
+
+
+def test_call_many_returns_replies_in_call_order(run):
+    async def scenario(channel):
+        rpc = RPC(channel)
+        await rpc.consume_queue(echo, "q", concurrency=10)
+        # Ответы приходят в обратном порядке, но возвращаются в порядке вызовов.
+        calls = [("q", {"index": index, "delay": 0.01 * (5 - index)}) for index in range(5)]
+        results = await rpc.call_many(calls, timeout=1)
+        await rpc.close()
+        return results
+
+    assert run(scenario) == [{"index": index} for index in range(5)]
+
+
+def test_slow_replies_become_timeouts(run):
+    async def scenario(channel):
+        rpc = RPC(channel)
+        await rpc.consume_queue(echo, "q", concurrency=10)
+        calls = [("q", {"index": index, "delay": 0.3 if index % 2 else 0}) for index in range(6)]
+        results = await rpc.call_many(calls, timeout=0.1, return_partial=True)
+        with pytest.raises(RPCTimeoutError):
+            await rpc.call_many(calls, deadline=0.1)
+        await rpc.close()
+        return results
+
+    results = run(scenario)
+    assert [isinstance(result, RPCTimeoutError) for result in results] == [False, True] * 3
+    assert results[::2] == [{"index": 0}, {"index": 2}, {"index": 4}]
+    assert not RPC.futures
+
+
+def test_reply_arriving_after_deadline_is_a_timeout(run, broker):
+    async def scenario(channel):
+        rpc = RPC(channel)
+        await channel.declare_queue("q")
+
+        def late_reply():
+            # Event loop занят дольше срока ожидания, ответ приходит уже после него,
+            # но до того как iter_many успевает обработать истечение срока.
+            time.sleep(0.15)
+            [(request, _)] = broker.queues["q"].messages
+            RPC.futures[request.correlation_id].set_result(request)
+
+        asyncio.get_event_loop().call_later(0.02, late_reply)
+        return [item async for item in rpc.iter_many([("q", {})], timeout=0.1)]
+
+    [(index, result)] = run(scenario)
+    assert index == 0
+    assert isinstance(result, RPCTimeoutError)
+
+
+def test_handler_errors_are_returned_per_call(run):
+    async def divide(value: int):
+        return 1 / value
+
+    async def scenario(channel):
+        rpc = RPC(channel)
+        await rpc.consume_queue(divide, "q", concurrency=2)
+        results = await rpc.call_many([("q", {"value": 0}), ("q", {"value": 2})], timeout=1, return_partial=True)
+        await wait_until(lambda: not channel.unacked)
+        await rpc.close()
+        return results
+
+    error, value = run(scenario)
+    assert isinstance(error, RPCError)
+    assert value == 0.5
+
+
+def test_call_many_uses_instance_timeout_by_default(run):
+    async def scenario(channel):
+        rpc = RPC(channel, timeout=0.05)
+        await channel.declare_queue("q")
+        # Запрос никто не обрабатывает, без timeout вызов ждал бы ответа бесконечно.
+        results = await asyncio.wait_for(rpc.call_many([("q", {})], return_partial=True), 1)
+        return results, dict(RPC.futures)
+
+    [result], futures = run(scenario)
+    assert isinstance(result, RPCTimeoutError)
+    assert not futures
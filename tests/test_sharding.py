@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import SRC_DIR, wait_until
+from rabbit.server import MessageQueue
+from rabbit.sharding import assign_shards, jump_hash, key_hash, shard_for, shard_name
+
+
+def test_jump_hash_values_are_stable():
+    # Значения закреплены: их изменение перемешает ключи по шардам у работающих сервисов.
+    assert [jump_hash(key, 10) for key in range(10)] == [0, 6, 6, 8, 1, 4, 9, 0, 4, 7]
+    assert [shard_for(f"user-{index}", 8) for index in range(8)] == [0, 4, 4, 3, 4, 7, 4, 1]
+
+
+def test_key_hash_does_not_depend_on_process_hash_seed():
+    code = "from rabbit.sharding import key_hash; print(key_hash('user-1'))"
+    for seed in ("1", "2"):
+        output = subprocess.check_output(
+            [sys.executable, "-c", code], env={**os.environ, "PYTHONHASHSEED": seed, "PYTHONPATH": SRC_DIR},
+        )
+        assert int(output) == key_hash("user-1") == 11145382709976293768
+    assert key_hash(b"user-1") == key_hash("user-1")
+
+
+def test_adding_shard_moves_keys_only_to_new_shard():
+    keys = [key_hash(index) for index in range(10000)]
+    for shards in (1, 4, 7):
+        before = [jump_hash(key, shards) for key in keys]
+        after = [jump_hash(key, shards + 1) for key in keys]
+        moved = [new for old, new in zip(before, after) if old != new]
+        assert set(moved) <= {shards}
+        # В новый шард переезжает примерно 1/(n + 1) ключей.
+        assert abs(len(moved) / len(keys) - 1 / (shards + 1)) < 0.02
+
+
+def test_assign_shards_covers_all_shards_once():
+    assigned = [shard for worker in range(3) for shard in assign_shards(8, worker, 3)]
+    assert sorted(assigned) == list(range(8))
+    with pytest.raises(ValueError):
+        assign_shards(8, 3, 3)
+
+
+def test_keyed_messages_keep_order_within_shard(run, broker):
+    received = {}
+
+    async def handler(message):
+        payload = json.loads(message.body)
+        received.setdefault(message.routing_key, []).append(payload)
+        await message.ack()
+
+    async def scenario(channel):
+        mq = MessageQueue(channel)
+        mq.set_queue_shards("q", 4)
+        group = await mq.consume_shards(handler, "q", shards=4)
+        for index in range(20):
+            key = f"key-{index % 5}"
+            await mq.send("q", {"key": key, "seq": index}, partition_key=key)
+        await wait_until(lambda: sum(map(len, received.values())) == 20)
+        await group.close()
+
+    run(scenario)
+    for queue_name, payloads in received.items():
+        for payload in payloads:
+            assert queue_name == shard_name("q", shard_for(payload["key"], 4))
+        for key in {payload["key"] for payload in payloads}:
+            seqs = [payload["seq"] for payload in payloads if payload["key"] == key]
+            assert seqs == sorted(seqs)